@@ -1,11 +1,41 @@
 from flask import Flask
 from flask_cors import CORS
 from flask_socketio import SocketIO
+import importlib
+import logging
 import os
+import time
 
 socketio = SocketIO(cors_allowed_origins="*")
 
+# Blueprints each deployment role needs (APP_ROLES in app_config.py). Only
+# these modules are imported, so e.g. a display node never loads the QR card
+# renderer or the Aadhaar decoder.
+ROLE_BLUEPRINTS = {
+    "display": [("announcement_api", "announcement_bp")],
+    "registration": [("token_api", "token_bp")],
+    "scanner": [("scan_api", "scan_bp")],
+}
+
+
+class StartupTimer:
+    """Milliseconds spent in each step of create_app, for the startup report."""
+
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def report(self, **fields):
+        return dict(fields, total_ms=round((time.perf_counter() - self.started) * 1000, 1), phases=self.phases)
+
+
 def create_app():
+    timer = StartupTimer()
     base_dir = os.path.abspath(os.path.dirname(__file__))
     root_dir = os.path.abspath(os.path.join(base_dir, ".."))
 
@@ -13,15 +43,72 @@ def create_app():
                 template_folder=os.path.join(root_dir, "templates"),
                 static_folder=os.path.join(root_dir, "static"))
 
+    from .log import configure_logging
+    configure_logging()
+
+    from app_config import APP_ROLES, AUTO_MIGRATE
+    roles = [r.strip() for r in APP_ROLES.split(",") if r.strip()]
+    unknown = set(roles) - set(ROLE_BLUEPRINTS)
+    if unknown:
+        raise ValueError(f"Unknown APP_ROLES {sorted(unknown)}; expected some of {sorted(ROLE_BLUEPRINTS)}")
+
     CORS(app)
 
-    from .announcement_api import announcement_bp
-    from .scan_api import scan_bp
-    from .token_api import token_bp
+    from . import metrics
+    metrics.init_app(app)
 
-    app.register_blueprint(announcement_bp)
-    app.register_blueprint(scan_bp)
-    app.register_blueprint(token_bp)
+    from .assets import assets
+    assets.init_app(app)
+    timer.mark("setup")
+
+    # Running under eventlet (run.py): keep database waits cooperative
+    import eventlet.patcher
+    if eventlet.patcher.is_monkey_patched("socket"):
+        from .db import enable_green_io
+        enable_green_io()
+
+    if AUTO_MIGRATE:
+        from .migrations import apply_migrations
+        apply_migrations()
+        timer.mark("migrations")
+
+    for role in roles:
+        for module_name, blueprint in ROLE_BLUEPRINTS[role]:
+            module = importlib.import_module(f".{module_name}", __name__)
+            app.register_blueprint(getattr(module, blueprint))
+        timer.mark(f"blueprints:{role}")
 
     socketio.init_app(app)
+
+    from .queue_engine import queue_engine
+    # The engine only sees this process's writes: with registrations served
+    # elsewhere it would propose tokens from a stale queue
+    if not {"display", "registration"} <= set(roles):
+        queue_engine.enabled = False
+    if queue_engine.enabled:
+        try:
+            queue_engine.warm()
+        except Exception as e:
+            # Departments load lazily on first use instead
+            logging.getLogger(__name__).warning("Queue engine warm-up failed: %s", e)
+        timer.mark("queue_engine")
+
+    from .event_bus import bus_enabled, start_listener
+    if bus_enabled():
+        start_listener(socketio)
+
+    # Partitions are needed where tokens are written; the no-show sweep
+    # updates the displays, so it runs with them. Scanner-only nodes run neither.
+    if "registration" in roles:
+        from .partitions import start_maintenance
+        start_maintenance(socketio)
+
+    if "display" in roles:
+        from .sweeper import start_sweeper
+        start_sweeper(socketio)
+    timer.mark("background_tasks")
+
+    report = timer.report(roles=roles)
+    metrics.startup_report.update(report)
+    logging.getLogger(__name__).info("App started", extra=report)
     return app
\ No newline at end of file
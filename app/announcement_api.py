@@ -1,155 +1,112 @@
-import eventlet
-eventlet.monkey_patch()
-
-from flask import Blueprint, jsonify, request, render_template
-from app import socketio
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from flask import Blueprint, jsonify, request
+from app import queries
+from app.db import get_db_connection, pool_stats
+from app.realtime import safe_emit, get_emit_stats
+from app.department_cache import department_cache
+from app.queue_engine import queue_engine
+from app.display_state import fetch_current_tokens
+from app.queue_stats import fetch_queue_stats, empty_stats, schedule_push
+from app.assets import assets
+from app.throttle import debounce, debouncer
+from app_config import CALL_MIN_INTERVAL_MS, ANNOUNCE_MIN_INTERVAL_MS
 from datetime import datetime
-from db_config import DB_HOST, DB_NAME, DB_USER, DB_PASS
+import psycopg2
+import hashlib
+import logging
 
 announcement_bp = Blueprint('announcement', __name__)
-
-def get_db_connection():
-    return psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+log = logging.getLogger(__name__)
 
 def fetch_department_name(department_id):
+    return department_cache.name(department_id)
+
+# ---------------- QUEUE TRANSITIONS ----------------
+# call-next and move-next each run as one round trip: the per-department
+# advisory lock plus the prepared transition statement (app/queries.py).
+def run_queue_transition(transition, department_id):
+    """Run a call-next/move-next transition.
+
+    Returns ``(current, next)``: the token whose status was changed and the
+    token now being served, each a dict or None.
+    """
+    candidate = queue_engine.next_candidate(department_id)
+    params = {
+        "department_id": department_id,
+        "candidate": candidate["token"] if candidate else None,
+        "candidate_status": candidate["status"] if candidate else None,
+    }
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT name FROM specializations WHERE specialization_id = %s", (department_id,))
-            result = cur.fetchone()
-            return result[0] if result else "Unknown"
-
-def fetch_current_token(department_id):
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT ct.token_number, pt.status
-                FROM current_token ct
-                JOIN patient_tokens pt ON pt.id = ct.token_number
-                WHERE ct.department_id = %s
-                ORDER BY ct.updated_at DESC
-                LIMIT 1
-            """, (department_id,))
-            return cur.fetchone()
-
-def fetch_next_token(department_id, skip_token_id=None):
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            for status in ('recall', 'waiting', 'hold'):
-                query = """
-                    SELECT pt.id, pt.token, pt.patient_id, p.first_name, p.last_name
-                    FROM patient_tokens pt
-                    JOIN patients p ON pt.patient_id = p.patient_id
-                    WHERE pt.datetime::date = CURRENT_DATE
-                      AND pt.status = %s
-                      AND pt.department_id = %s
-                """
-                params = [status, department_id]
-
-                if skip_token_id:
-                    query += " AND pt.id != %s"
-                    params.append(skip_token_id)
-
-                query += " ORDER BY pt.status_updated_at ASC LIMIT 1"
-
-                cur.execute(query, params)
-                row = cur.fetchone()
-                if row:
-                    return {
-                        "uuid": row["token"],
-                        "token": row["id"],
-                        "name": f"{row['first_name']} {row['last_name']}",
-                        "patient_id": row["patient_id"],
-                        "department_id": department_id
-                    }
-    return None
-
-def safe_emit(event, data):
-    try:
-        socketio.emit(event, data)
-    except Exception as e:
-        print(f"⚠ SocketIO emit failed: {e}")
+            queries.execute(cur, transition, params, prefix=queries.QUEUE_LOCK_SQL)
+            rows = cur.fetchall()
+
+    result = {"current": None, "next": None}
+    for role, token_number, token, patient_id, status, status_updated_at, first_name, last_name in rows:
+        result[role] = {
+            "uuid": token,
+            "token": token_number,
+            "name": f"{first_name} {last_name}",
+            "patient_id": patient_id,
+            "status": status,
+            "status_updated_at": status_updated_at,
+            "department_id": department_id
+        }
+
+    queue_engine.apply_transition(department_id, candidate, result["current"], result["next"])
+    if rows:
+        schedule_push(department_id)
+    return result["current"], result["next"]
 
 @announcement_bp.route('/')
 def health_check():
     return jsonify({"status": "API running"}), 200
 
+@announcement_bp.route('/api/db-pool', methods=['GET'])
+def db_pool_stats():
+    return jsonify(pool_stats()), 200
+
+@announcement_bp.route('/api/queue-engine', methods=['GET'])
+def queue_engine_stats():
+    return jsonify(queue_engine.stats()), 200
+
+@announcement_bp.route('/api/queue-engine/check', methods=['GET'])
+def queue_engine_check():
+    # ?repair=1 reloads every department that differs from the database
+    department_id = request.args.get("department_id")
+    differences = queue_engine.diff(department_id)
+    if request.args.get("repair") == "1":
+        for key in differences:
+            queue_engine.resync(key)
+    return jsonify({"consistent": not differences, "differences": differences}), 200
+
+@announcement_bp.route('/api/emit-stats', methods=['GET'])
+def emit_stats():
+    stats = get_emit_stats()
+    stats["rate_limited"] = debouncer.stats()
+    return jsonify(stats), 200
+
 @announcement_bp.route('/api/call-next', methods=['POST'])
+@debounce("call", CALL_MIN_INTERVAL_MS)
 def call_next():
     data = request.get_json()
     department_id = data.get("department_id")
     if not department_id:
         return jsonify({"error": "Missing department_id"}), 400
 
-    current = fetch_current_token(department_id)
-    token_id = current["token_number"] if current else None
-
-    if token_id:
-        print(f"✅ Marking token {token_id} as completed (forced)")
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE patient_tokens
-                    SET status = 'completed', status_updated_at = NOW()
-                    WHERE id = %s
-                """, (token_id,))
-                conn.commit()
-    else:
-        print("⚠️ No token to complete.")
-
-    # Step 2: Fetch next eligible token
-    next_token = fetch_next_token(department_id)
+    completed, next_token = run_queue_transition("call_next", department_id)
+    log.info("call-next", extra={
+        "department_id": department_id,
+        "completed_token": completed["token"] if completed else None,
+        "token": next_token["token"] if next_token else None,
+    })
 
-    # Step 3: If found, conditionally update to consulting
     if next_token:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                # Check the status of the selected token
-                cur.execute("SELECT status FROM patient_tokens WHERE id = %s", (next_token["token"],))
-                status_row = cur.fetchone()
-                token_status = status_row[0] if status_row else None
-
-                # Only promote to consulting if token is in 'waiting'
-                if token_status == "waiting":
-                    cur.execute("""
-                        UPDATE patient_tokens
-                        SET status = 'consulting', status_updated_at = NOW()
-                        WHERE id = %s
-                    """, (next_token["token"],))
-
-                # Always update current_token table
-                cur.execute("""
-                    INSERT INTO current_token (token_uuid, token_number, patient_id, department_id, updated_at)
-                    VALUES (%s, %s, %s, %s, NOW())
-                    ON CONFLICT (department_id) DO UPDATE SET
-                        token_uuid = EXCLUDED.token_uuid,
-                        token_number = EXCLUDED.token_number,
-                        patient_id = EXCLUDED.patient_id,
-                        updated_at = NOW()
-                """, (
-                    next_token["uuid"],
-                    next_token["token"],
-                    next_token["patient_id"],
-                    next_token["department_id"]
-                ))
-                conn.commit()
-
-        # Step 4: Emit update
         safe_emit('update-token', {
             "token": next_token["token"],
             "name": next_token["name"],
             "department_id": department_id,
-            "status": token_status or "consulting"
-        })
-        
-        print("📤 Final API response:", {
-            "token": next_token["token"],
-            "name": next_token["name"],
-            "patient_id": next_token["patient_id"],
-            "department": fetch_department_name(department_id)
-})
-
+            "status": next_token["status"]
+        }, department_id)
 
         return jsonify({
             "token": next_token["token"],
@@ -165,118 +122,41 @@ def call_next():
             "name": "No more tokens",
             "department_id": department_id,
             "force": True
-        })
+        }, department_id)
         return jsonify({"message": "No more tokens"}), 200
 
 
 @announcement_bp.route('/api/move-next', methods=['POST'])
+@debounce("call", CALL_MIN_INTERVAL_MS)
 def move_next():
     data = request.get_json()
     department_id = data.get("department_id")
     if not department_id:
         return jsonify({"error": "Missing department_id"}), 400
 
-    current_token_id = None
-    current_status = None
-    new_status = None
-    patient_name = "Unknown"
+    moved, next_token = run_queue_transition("move_next", department_id)
+    log.info("move-next", extra={
+        "department_id": department_id,
+        "moved_token": moved["token"] if moved else None,
+        "moved_status": moved["status"] if moved else None,
+        "token": next_token["token"] if next_token else None,
+    })
 
-    # Step 1: Identify current token
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT ct.token_number, p.first_name, p.last_name
-                FROM current_token ct
-                JOIN patient_tokens pt ON pt.id = ct.token_number
-                JOIN patients p ON pt.patient_id = p.patient_id
-                WHERE ct.department_id = %s
-                ORDER BY ct.updated_at DESC
-                LIMIT 1
-            """, (department_id,))
-            row = cur.fetchone()
-            if row:
-                current_token_id = row["token_number"]
-                patient_name = f"{row['first_name']} {row['last_name']}"
+    if moved:
+        safe_emit('update-token', {
+            "token": moved["token"],
+            "name": moved["name"],
+            "department_id": department_id,
+            "status": moved["status"]
+        }, department_id)
 
-    # Step 2: If current token found, update its status
-    if current_token_id:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT status FROM patient_tokens WHERE id = %s", (current_token_id,))
-                row = cur.fetchone()
-                if row:
-                    current_status = row[0]
-                    # Determine next status based on lifecycle
-                    if current_status == "consulting":
-                        new_status = "recall"
-                    elif current_status == "recall":
-                        new_status = "hold"
-                    elif current_status == "hold":
-                        new_status = "no_show"
-                    else:
-                        new_status = "recall"  # fallback for unexpected state
-
-                    # Update the status
-                    cur.execute("""
-                        UPDATE patient_tokens
-                        SET status = %s, status_updated_at = NOW()
-                        WHERE id = %s
-                    """, (new_status, current_token_id))
-                    conn.commit()
-
-                    print(f"✅ Token {current_token_id} marked as {new_status}")
-
-                    # Emit token status update
-                    safe_emit('update-token', {
-                        "token": current_token_id,
-                        "name": patient_name,
-                        "department_id": department_id,
-                        "status": new_status
-                    })
-
-    # Step 3: Fetch the next eligible token, skipping the current one
-    next_token = fetch_next_token(department_id, skip_token_id=current_token_id)
-
-    # Step 4: Assign next token (if found)
     if next_token:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                # Check the token's current status
-                cur.execute("SELECT status FROM patient_tokens WHERE id = %s", (next_token["token"],))
-                status_row = cur.fetchone()
-                if status_row and status_row[0] == "waiting":
-                    # Only promote to consulting if it's in waiting
-                    cur.execute("""
-                        UPDATE patient_tokens
-                        SET status = 'consulting', status_updated_at = NOW()
-                        WHERE id = %s
-                    """, (next_token["token"],))
-
-                # Always update current_token table
-                cur.execute("""
-                    INSERT INTO current_token (token_uuid, token_number, patient_id, department_id, updated_at)
-                    VALUES (%s, %s, %s, %s, NOW())
-                    ON CONFLICT (department_id) DO UPDATE SET
-                        token_uuid = EXCLUDED.token_uuid,
-                        token_number = EXCLUDED.token_number,
-                        patient_id = EXCLUDED.patient_id,
-                        updated_at = NOW()
-                """, (
-                    next_token["uuid"],
-                    next_token["token"],
-                    next_token["patient_id"],
-                    next_token["department_id"]
-                ))
-                conn.commit()
-
-        print(f"✅ Now showing token {next_token['token']}")
-
         safe_emit('update-token', {
             "token": next_token["token"],
             "name": next_token["name"],
             "department_id": department_id,
-            "status": status_row[0] if status_row else "consulting"
-        })
+            "status": next_token["status"]
+        }, department_id)
 
         return jsonify({
             "token": next_token["token"],
@@ -286,65 +166,164 @@ def move_next():
         }), 200
 
     else:
-        print("ℹ️ No eligible tokens to call next.")
-
         safe_emit('update-token', {
             "token": "--",
             "name": "No more tokens",
             "department_id": department_id,
             "force": True
-        })
+        }, department_id)
         return jsonify({"message": "No more tokens"}), 200
 
 
+TOKEN_STATUSES = ("waiting", "consulting", "recall", "hold", "no_show", "completed")
+
+@announcement_bp.route('/api/tokens/transition', methods=['POST'])
+def bulk_transition():
+    """Move every token of today's queue in ``from_status`` to ``to_status`` in one UPDATE.
+
+    Body: {"department_id", "from_status": "hold" or [...], "to_status", "tokens": [uuid, ...] (optional)}
+    """
+    data = request.get_json(silent=True) or {}
+    department_id = data.get("department_id")
+    from_statuses = data.get("from_status")
+    to_status = data.get("to_status")
+    tokens = data.get("tokens")
+    if isinstance(from_statuses, str):
+        from_statuses = [from_statuses]
+    if not department_id or not from_statuses or not to_status:
+        return jsonify({"error": "department_id, from_status and to_status are required"}), 400
+    if not isinstance(from_statuses, list) or not all(isinstance(s, str) for s in from_statuses):
+        return jsonify({"error": "from_status must be a status or a list of statuses"}), 400
+    if not isinstance(to_status, str):
+        return jsonify({"error": "to_status must be a status"}), 400
+    invalid = sorted(set(from_statuses + [to_status]) - set(TOKEN_STATUSES))
+    if invalid:
+        return jsonify({"error": f"Unknown status: {', '.join(invalid)}"}), 400
+    if tokens is not None and not isinstance(tokens, list):
+        return jsonify({"error": "tokens must be a list"}), 400
+
+    params = {
+        "department_id": str(department_id),
+        "from_statuses": from_statuses,
+        "to_status": to_status,
+        "tokens": tokens,
+    }
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Same per-department lock as call-next/move-next
+                queries.execute(cur, "bulk_transition", params, prefix=queries.QUEUE_LOCK_SQL)
+                rows = cur.fetchall()
+    except psycopg2.DataError as e:
+        return jsonify({"error": str(e).splitlines()[0]}), 400
+
+    queue_engine.apply_statuses(department_id, [(token, status, updated_at)
+                                                for token, _, status, updated_at, *_ in rows])
+    log.info("tokens-transitioned", extra={
+        "department_id": department_id, "from_status": from_statuses, "to_status": to_status, "count": len(rows),
+    })
+
+    if rows:
+        safe_emit('tokens-transitioned', {
+            "department_id": department_id,
+            "from_status": from_statuses,
+            "to_status": to_status,
+            "count": len(rows),
+            "tokens": [token_number for _, token_number, *_ in rows],
+        }, department_id)
+        # The token on the display changed status too; keep the screens' state right
+        for _, token_number, status, _, is_current, first_name, last_name in rows:
+            if is_current:
+                safe_emit('update-token', {
+                    "token": token_number,
+                    "name": f"{first_name} {last_name}",
+                    "department_id": department_id,
+                    "status": status
+                }, department_id)
+        schedule_push(department_id)
+
+    return jsonify({"updated": len(rows), "tokens": [token_number for _, token_number, *_ in rows]}), 200
+
 @announcement_bp.route('/api/current-token', methods=['GET'])
 def get_current_token():
     department_id = request.args.get("department_id")
     if not department_id:
         return jsonify({"error": "Missing department_id"}), 400
 
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT ct.token_number, p.first_name, p.last_name
-                FROM current_token ct
-                JOIN patients p ON ct.patient_id = p.patient_id
-                WHERE ct.department_id = %s
-                ORDER BY ct.updated_at DESC
-                LIMIT 1
-            """, (department_id,))
-            row = cur.fetchone()
-            if row:
-                return jsonify({
-                    "token": row["token_number"],
-                    "name": f"{row['first_name']} {row['last_name']}",
-                    "patient_id": row.get("patient_id"),
-                    "department": fetch_department_name(department_id)
-                }), 200
-            else:
-                return jsonify({"message": "No current token"}), 200
+    tokens = fetch_current_tokens([department_id])
+    if tokens:
+        current = tokens[0]
+        return jsonify({
+            "token": current["token"],
+            "name": current["name"],
+            "patient_id": current["patient_id"],
+            "status": current["status"],
+            "department": current["department"]
+        }), 200
+    else:
+        return jsonify({"message": "No current token"}), 200
+
+@announcement_bp.route('/api/current-tokens', methods=['GET'])
+def get_current_tokens():
+    # ?department_ids=1,2,3 limits the snapshot; without it every department is returned
+    department_ids = request.args.get("department_ids")
+    if department_ids is not None:
+        department_ids = [d.strip() for d in department_ids.split(",") if d.strip()]
+
+    response = jsonify({"tokens": fetch_current_tokens(department_ids)})
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@announcement_bp.route('/api/queue-stats', methods=['GET'])
+def get_queue_stats():
+    # ?department_ids=1,2,3 (or ?department_id=1); without either every department with tokens today
+    department_ids = request.args.get("department_ids") or request.args.get("department_id")
+    if department_ids is not None:
+        department_ids = [d.strip() for d in department_ids.split(",") if d.strip()]
+        stats = fetch_queue_stats(department_ids)
+        stats = {d: stats.get(d) or empty_stats(d) for d in department_ids}
+    else:
+        stats = fetch_queue_stats()
+
+    response = jsonify({"departments": list(stats.values())})
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @announcement_bp.route('/doctor-display')
 def doctor_display():
-    return render_template("doctor_display.html")
+    return assets.page("doctor_display.html")
 
 @announcement_bp.route('/waiting-display')
 def waiting_display():
-    return render_template("waiting_display.html")
+    return assets.page("waiting_display.html")
 
 @announcement_bp.route('/multi-waiting-display')
 def multi_waiting_display():
-    return render_template("multi_waiting_display.html")
+    return assets.page("multi_waiting_display.html")
 
 @announcement_bp.route('/api/departments', methods=['GET'])
 def get_departments():
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT specialization_id AS id, name FROM specializations")
-            departments = cur.fetchall()
-            return jsonify({"departments": departments}), 200
+    return jsonify({"departments": department_cache.all()}), 200
+
+@announcement_bp.route('/api/department-name', methods=['GET'])
+def get_department_name():
+    department_id = request.args.get("department_id")
+    if not department_id:
+        return jsonify({"error": "Missing department_id"}), 400
+    return jsonify({"department_id": department_id, "department_name": fetch_department_name(department_id)}), 200
+
+@announcement_bp.route('/api/departments/cache', methods=['GET'])
+def department_cache_stats():
+    return jsonify(department_cache.stats()), 200
+
+@announcement_bp.route('/api/departments/refresh', methods=['POST'])
+def refresh_departments():
+    department_cache.invalidate()
+    return jsonify({"success": True, "departments": len(department_cache.all())}), 200
 
 @announcement_bp.route('/api/announce-current', methods=['POST'])
+@debounce("announce", ANNOUNCE_MIN_INTERVAL_MS)
 def announce_current():
     data = request.get_json()
     department_id = data.get("department_id")
@@ -352,23 +331,18 @@ def announce_current():
         return jsonify({"error": "Missing department_id"}), 400
 
     with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT ct.token_number, p.first_name, p.last_name
-                FROM current_token ct
-                JOIN patients p ON ct.patient_id = p.patient_id
-                WHERE ct.department_id = %s
-                ORDER BY updated_at DESC
-                LIMIT 1
-            """, (department_id,))
+        with conn.cursor() as cur:
+            queries.execute(cur, "announce_current", {"department_id": department_id})
             row = cur.fetchone()
             if row:
+                token_number, first_name, last_name, status = row
                 safe_emit('update-token', {
-                    "token": row["token_number"],
-                    "name": f"{row['first_name']} {row['last_name']}",
+                    "token": token_number,
+                    "name": f"{first_name} {last_name}",
                     "department_id": department_id,
+                    "status": status,
                     "force": True
-                })
+                }, department_id)
                 return jsonify({"success": True, "message": "Announcement repeated"}), 200
             else:
                 return jsonify({"success": False, "message": "No current token"}), 200
@@ -0,0 +1,142 @@
+"""Static assets with fingerprinted URLs, precompressed bodies and byte ranges.
+
+At startup every file under static/ is read once, hashed and, for text
+types, gzip- (and, with the optional ``brotli`` package, brotli-) compressed.
+Templates link ``{{ asset_url("vendor/socket.io.min.js") }}``, which becomes
+``/assets/vendor/socket.io.min.<hash>.js``; that URL changes whenever the
+file does, so it is served with a one-year immutable Cache-Control and
+displays never re-download it. Byte-range requests (audio seeking) and
+If-None-Match are answered from memory as well.
+
+The display pages are rendered once per process and served the same way,
+but revalidated on every load so a deploy reaches them.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+
+from flask import abort, current_app, render_template, request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {".js", ".css", ".html", ".json", ".svg", ".txt", ".map", ".wav"}
+# Smaller than this and the headers outweigh the savings
+MIN_COMPRESS_SIZE = 512
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class Asset:
+    def __init__(self, name, body, mimetype):
+        self.name = name
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = posixpath.splitext(name)
+        self.url_name = f"{stem}.{self.digest}{ext}"
+        self.bodies = {"identity": body}
+        if ext in COMPRESSIBLE and len(body) >= MIN_COMPRESS_SIZE:
+            self._add("gzip", gzip.compress(body, 9, mtime=0))
+            if brotli is not None:
+                self._add("br", brotli.compress(body))
+
+    def _add(self, encoding, compressed):
+        # Audio and already-dense files barely shrink; not worth a variant
+        if len(compressed) < len(self.bodies["identity"]) * 0.9:
+            self.bodies[encoding] = compressed
+
+
+def _negotiate(available):
+    """Best encoding the client accepts; identity for range requests, so offsets refer to the file."""
+    if request.range is None:
+        for encoding in ("br", "gzip"):
+            if encoding in available and request.accept_encodings[encoding]:
+                return encoding
+    return "identity"
+
+
+def _respond(asset, cache_control):
+    encoding = _negotiate(asset.bodies)
+    body = asset.bodies[encoding]
+    response = Response(body, mimetype=asset.mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    if len(asset.bodies) > 1:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = cache_control
+    response.set_etag(f"{asset.digest}-{encoding}")
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
+
+# ---------------- ASSET STORE ----------------
+class AssetStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assets = {}      # "vendor/socket.io.min.js" -> Asset
+        self._by_url = {}      # "vendor/socket.io.min.<hash>.js" -> Asset
+        self._pages = {}       # template name -> Asset
+
+    def load(self, folder):
+        assets = {}
+        for directory, _, files in os.walk(folder):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    body = f.read()
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                assets[name] = Asset(name, body, mimetype)
+        with self._lock:
+            self._assets = assets
+            self._by_url = {asset.url_name: asset for asset in assets.values()}
+            self._pages = {}
+
+    def url(self, *names):
+        """Fingerprinted URL of the first of ``names`` that exists."""
+        for name in names:
+            asset = self._assets.get(name)
+            if asset is not None:
+                return f"/assets/{asset.url_name}"
+        return f"/static/{names[0]}"
+
+    def serve(self, filename):
+        asset = self._by_url.get(filename)
+        if asset is not None:
+            return _respond(asset, IMMUTABLE)
+        # Unfingerprinted name: still served, but checked for changes on each use
+        asset = self._assets.get(filename)
+        if asset is None:
+            abort(404)
+        return _respond(asset, REVALIDATE)
+
+    def page(self, template):
+        """Render a template that has no per-request content once, then serve it from memory."""
+        asset = None if current_app.debug else self._pages.get(template)
+        if asset is None:
+            asset = Asset(template, render_template(template).encode("utf-8"), "text/html")
+            self._pages[template] = asset
+        return _respond(asset, REVALIDATE)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    "url": f"/assets/{asset.url_name}",
+                    "bytes": {encoding: len(body) for encoding, body in asset.bodies.items()},
+                }
+                for name, asset in sorted(self._assets.items())
+            }
+
+    def init_app(self, app):
+        self.load(app.static_folder)
+        app.add_url_rule("/assets/<path:filename>", "assets", self.serve, methods=["GET"])
+        app.jinja_env.globals["asset_url"] = self.url
+
+
+assets = AssetStore()
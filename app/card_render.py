@@ -0,0 +1,326 @@
+import io
+import os
+import pickle
+import queue
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+
+from app.metrics import card_render_duration, card_render_failures
+from app_config import (CARD_RENDER_WORKERS, CARD_RENDER_TIMEOUT, CARD_CACHE_SIZE,
+                        CARD_CACHE_DIR, CARD_FONT)
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# ---------------- RENDERING (runs in pool workers) ----------------
+# qrcode and PIL are imported on first render, so only processes that draw
+# cards (the render workers, or the app with CARD_RENDER_WORKERS=0) load them
+_font = None
+_template = None
+
+
+def _init_worker():
+    """Load the font and blank card once per worker process."""
+    global _font, _template
+    from PIL import Image, ImageFont
+    try:
+        _font = ImageFont.truetype(CARD_FONT, 12)
+    except OSError:
+        _font = ImageFont.load_default()
+    _template = Image.new("RGB", (400, 400), color="white")
+
+
+def render_card_png(patient_id, name, department_name, valid_till, daily_id, qr_url):
+    import qrcode
+    from PIL import ImageDraw
+
+    if _template is None:
+        _init_worker()
+
+    qr = qrcode.make(qr_url)
+    qr = qr.resize((200, 200))
+
+    card = _template.copy()
+    draw = ImageDraw.Draw(card)
+
+    qr_x = (card.width - qr.width) // 2
+    card.paste(qr, (qr_x, 10))
+
+    text_y_start = 230
+    line_height = 20
+    draw.text((20, text_y_start + 0 * line_height), f"Patient ID: {patient_id}", fill="black", font=_font)
+    draw.text((20, text_y_start + 1 * line_height), f"Name: {name}", fill="black", font=_font)
+    draw.text((20, text_y_start + 2 * line_height), f"Department: {department_name}", fill="black", font=_font)
+    draw.text((20, text_y_start + 3 * line_height), f"Valid till: {valid_till.strftime('%Y-%m-%d %H:%M')}", fill="black", font=_font)
+    draw.text((20, text_y_start + 4 * line_height), f"Token number: {daily_id}", fill="black", font=_font)
+
+    buf = io.BytesIO()
+    card.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# ---------------- WORKER PROCESSES ----------------
+# Cards are rendered by long-lived `python -m app.card_render` children that
+# talk length-prefixed pickles over stdin/stdout. Under eventlet the pipes are
+# green, so a request waiting on a render only parks its own greenlet while
+# the PIL work runs on another core. (concurrent.futures' process pool
+# deadlocks once eventlet has monkey-patched threading.)
+def _write_message(stream, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(struct.pack("!I", len(data)) + data)
+    stream.flush()
+
+
+def _read_exact(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError("card render worker closed its pipe")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_message(stream):
+    (size,) = struct.unpack("!I", _read_exact(stream, 4))
+    return pickle.loads(_read_exact(stream, size))
+
+
+class RenderWorkerPool:
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._started = 0
+
+    def _spawn(self):
+        return subprocess.Popen([sys.executable, "-m", "app.card_render"], cwd=ROOT_DIR,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle.empty() and self._started < self.size:
+                self._started += 1
+                spawn = True
+            else:
+                spawn = False
+        if spawn:
+            try:
+                return self._spawn()
+            except Exception:
+                with self._lock:
+                    self._started -= 1
+                raise
+        return self._idle.get(timeout=self.timeout)
+
+    def _retire(self, proc):
+        with self._lock:
+            self._started -= 1
+        try:
+            proc.kill()
+            proc.wait()
+        except Exception:
+            pass
+
+    def render(self, args):
+        proc = self._checkout()
+        timeout = _render_timeout(self.timeout)
+        try:
+            with timeout:
+                _write_message(proc.stdin, args)
+                status, result = _read_message(proc.stdout)
+        except BaseException as e:
+            # The worker may be mid-message; never reuse it
+            self._retire(proc)
+            if e is timeout:
+                # eventlet.Timeout is a BaseException; callers handle Exception
+                raise TimeoutError(f"card render took longer than {self.timeout}s") from None
+            raise
+        self._idle.put(proc)
+        if status != "ok":
+            raise RuntimeError(f"card render failed: {result}")
+        return result
+
+
+def _render_timeout(seconds):
+    import eventlet.patcher
+    if eventlet.patcher.is_monkey_patched("socket"):
+        import eventlet
+        return eventlet.Timeout(seconds)
+    from contextlib import nullcontext
+    return nullcontext()
+
+
+_pool = RenderWorkerPool(CARD_RENDER_WORKERS, CARD_RENDER_TIMEOUT)
+
+
+def render_card(*args):
+    """Render a card in a worker process (in-process if workers are disabled)."""
+    started = time.perf_counter()
+    try:
+        if CARD_RENDER_WORKERS <= 0:
+            png = render_card_png(*args)
+        else:
+            png = _pool.render(args)
+    except Exception:
+        card_render_failures.inc()
+        raise
+    card_render_duration.observe(time.perf_counter() - started)
+    return png
+
+
+def submit_render(*args):
+    """Start rendering a card in the background; returns a Future of PNG bytes."""
+    future = Future()
+
+    def _run():
+        try:
+            future.set_result(render_card(*args))
+        except BaseException as e:
+            # Resolve it whatever happened, or CardCache keeps it pending
+            future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    threading.Thread(target=_run, daemon=True).start()
+    return future
+
+
+def _worker_main():
+    _init_worker()
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        try:
+            args = _read_message(stdin)
+        except EOFError:
+            return
+        try:
+            _write_message(stdout, ("ok", render_card_png(*args)))
+        except Exception as e:
+            _write_message(stdout, ("error", repr(e)))
+
+
+# ---------------- CARD CACHE ----------------
+class CardCache:
+    """LRU of rendered cards keyed by token UUID, optionally backed by a directory.
+
+    Each card is kept with its token's ``expires_at`` so every response for it
+    can be cached exactly that long; on disk the expiry is the file's mtime.
+    """
+
+    def __init__(self, max_entries, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stored": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, token):
+        return os.path.join(self.directory, f"{token}.png")
+
+    def get(self, token):
+        """``(png, expires_at)`` for a cached or in-flight card, else ``None``."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                self._entries.move_to_end(token)
+                self._stats["hits"] += 1
+                return entry
+            pending = self._pending.get(token)
+
+        if pending is not None:
+            future, expires_at = pending
+            try:
+                png = future.result(timeout=CARD_RENDER_TIMEOUT)
+                self._stats["hits"] += 1
+                return png, expires_at
+            except Exception:
+                pass
+
+        if self.directory:
+            try:
+                expires_at = datetime.fromtimestamp(os.path.getmtime(self._path(token)))
+                # An expired token's file is left for prune() rather than served
+                if expires_at > datetime.now():
+                    with open(self._path(token), "rb") as f:
+                        png = f.read()
+                    self._remember(token, png, expires_at)
+                    self._stats["disk_hits"] += 1
+                    return png, expires_at
+            except FileNotFoundError:
+                pass
+
+        self._stats["misses"] += 1
+        return None
+
+    def _remember(self, token, png, expires_at):
+        with self._lock:
+            self._entries[token] = (png, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, token, png, expires_at):
+        self._remember(token, png, expires_at)
+        self._stats["stored"] += 1
+        if self.directory:
+            tmp_path = self._path(token) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(png)
+            expiry = expires_at.timestamp()
+            os.utime(tmp_path, (expiry, expiry))
+            os.replace(tmp_path, self._path(token))
+
+    def put_pending(self, token, future, expires_at):
+        """Track an in-flight render so a GET for it waits instead of re-rendering."""
+        with self._lock:
+            self._pending[token] = (future, expires_at)
+
+        def _done(f):
+            with self._lock:
+                self._pending.pop(token, None)
+            if f.exception() is None:
+                self.put(token, f.result(), expires_at)
+
+        future.add_done_callback(_done)
+
+    def prune(self):
+        """Delete card files whose token has expired; returns how many were removed."""
+        if not self.directory:
+            return 0
+        now = time.time()
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".png"):
+                    continue
+                try:
+                    if entry.stat().st_mtime < now:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Another worker sharing the directory got there first
+                    pass
+        return removed
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries), pending=len(self._pending))
+        return stats
+
+
+card_cache = CardCache(CARD_CACHE_SIZE, CARD_CACHE_DIR)
+
+
+if __name__ == "__main__":
+    _worker_main()
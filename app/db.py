@@ -0,0 +1,307 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from app.metrics import observe_query
+from db_config import (DB_HOST, DB_NAME, DB_USER, DB_PASS, DB_POOL_MIN, DB_POOL_MAX,
+                       DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# ---------------- ROUND-TRIP COUNTING ----------------
+# Every statement, commit and rollback on a pooled connection is one round
+# trip to the server; the totals are reported with the pool stats so load
+# tests can work out round trips per request. Statements are also timed for
+# /metrics (app/metrics.py).
+round_trips = {"statements": 0, "commits": 0, "rollbacks": 0}
+
+_counting_factories = {}
+
+
+def _counting_cursor(factory):
+    counting = _counting_factories.get(factory)
+    if counting is None:
+        class counting(factory):
+            # Set by app.queries.execute() while it runs a catalog statement
+            statement_name = None
+
+            def execute(self, query, vars=None):
+                round_trips["statements"] += 1
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    observe_query(query, time.perf_counter() - started, statement=self.statement_name)
+
+            def executemany(self, query, vars_list):
+                vars_list = list(vars_list)
+                round_trips["statements"] += len(vars_list)
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    observe_query(query, time.perf_counter() - started, statement=self.statement_name)
+
+        counting.__name__ = "Counting" + factory.__name__
+        _counting_factories[factory] = counting
+    return counting
+
+
+class CountingConnection(extensions.connection):
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or extensions.cursor
+        kwargs["cursor_factory"] = _counting_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+    # psycopg2 skips the round trip when no transaction is open
+    def commit(self):
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            round_trips["commits"] += 1
+        return super().commit()
+
+    def rollback(self):
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            round_trips["rollbacks"] += 1
+        return super().rollback()
+
+
+# ---------------- CONNECTION POOL ----------------
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections.
+
+    Idle connections are kept LIFO so the warmest one is reused first. A
+    connection that sat idle longer than ``check_idle`` seconds is pinged with
+    ``SELECT 1`` before it is handed out, and replaced if the ping fails.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, check_idle, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, returned_at)]
+        self._in_use = set()
+        self._pending = 0      # slots reserved for connections being opened
+        self._filled = False
+
+        self._stats = {
+            "checkouts": 0,
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "health_check_failures": 0,
+            "timeouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=CountingConnection, **self.connect_kwargs)
+        self._stats["connections_opened"] += 1
+        return conn
+
+    def _close(self, conn):
+        self._stats["connections_closed"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._pending
+
+    def _fill(self):
+        while self._size() < self.minconn:
+            self._idle.append((self._connect(), time.monotonic()))
+        self._filled = True
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+        with self._cond:
+            if not self._filled:
+                self._fill()
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    # Reserve the slot before the (possibly slow) health check
+                    self._in_use.add(conn)
+                    break
+                if self._size() < self.maxconn:
+                    conn, returned_at = None, None
+                    self._pending += 1
+                    break
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout("no database connection available after %.1fs" % self.timeout)
+                self._cond.wait(remaining)
+
+            if waited_since is not None:
+                waited = time.monotonic() - waited_since
+                self._stats["wait_time_total"] += waited
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+            self._stats["checkouts"] += 1
+
+        try:
+            if conn is not None and not self._healthy(conn, time.monotonic() - returned_at):
+                self._stats["health_check_failures"] += 1
+                self._close(conn)
+                with self._cond:
+                    self._in_use.discard(conn)
+                    self._pending += 1
+                conn = None
+            if conn is None:
+                new_conn = self._connect()
+                with self._cond:
+                    self._pending -= 1
+                    self._in_use.add(new_conn)
+                conn = new_conn
+        except Exception:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+        with self._cond:
+            self._in_use.discard(conn)
+            if discard or conn.closed or len(self._idle) >= self.maxconn:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._idle = []
+            self._filled = False
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+            })
+        stats["wait_time_avg"] = (stats["wait_time_total"] / stats["waits"]) if stats["waits"] else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE,
+                    host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS,
+                )
+    return _pool
+
+
+@contextmanager
+def get_db_connection():
+    """Check a connection out of the shared pool.
+
+    Commits when the block exits cleanly and rolls back on error, then
+    returns the connection to the pool.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+
+def pool_stats():
+    from app.queries import statement_stats
+
+    stats = get_pool().stats()
+    stats["round_trips"] = dict(round_trips, total=sum(round_trips.values()))
+    stats["statements"] = dict(statement_stats)
+    return stats
+
+
+# ---------------- GREEN (EVENTLET) I/O ----------------
+def _eventlet_wait_callback(conn, timeout=-1):
+    from eventlet.hubs import trampoline
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+
+def enable_green_io():
+    """Make psycopg2 yield to the eventlet hub while it waits on the server.
+
+    psycopg2 does its socket I/O in C, which monkey_patch() cannot reach, so
+    without this every query blocks all greenlets (Socket.IO heartbeats
+    included) until it returns. With the wait callback installed libpq runs
+    in non-blocking mode and each wait goes through the eventlet hub.
+    """
+    extensions.set_wait_callback(_eventlet_wait_callback)
+
+
+def green_io_enabled():
+    return extensions.get_wait_callback() is _eventlet_wait_callback
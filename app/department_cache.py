@@ -0,0 +1,81 @@
+import threading
+import time
+
+from app.db import get_db_connection
+from app_config import DEPARTMENT_CACHE_TTL
+
+# A lookup for an id missing from the snapshot reloads at most this often,
+# so a bad department_id cannot turn every request into a table read.
+MISSING_ID_RELOAD_INTERVAL = 30
+
+
+# ---------------- DEPARTMENT CACHE ----------------
+class DepartmentCache:
+    """In-process copy of the specializations table.
+
+    The whole table is reloaded when the snapshot is older than ``ttl`` or
+    after ``invalidate()``; lookups in between never touch the database.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._departments = None   # [{"id", "name"}] in table order
+        self._names = {}
+        self._loaded_at = 0.0
+        self._stats = {"hits": 0, "misses": 0, "reloads": 0, "invalidations": 0}
+
+    def _reload(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT specialization_id AS id, name FROM specializations")
+                rows = cur.fetchall()
+        self._departments = [{"id": row[0], "name": row[1]} for row in rows]
+        self._names = {str(row[0]): row[1] for row in rows}
+        self._loaded_at = time.monotonic()
+        self._stats["reloads"] += 1
+
+    def _fresh(self):
+        return self._departments is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _ensure_loaded(self):
+        if self._fresh():
+            self._stats["hits"] += 1
+            return
+        with self._lock:
+            if self._fresh():
+                self._stats["hits"] += 1
+                return
+            self._stats["misses"] += 1
+            self._reload()
+
+    def all(self):
+        self._ensure_loaded()
+        return list(self._departments)
+
+    def name(self, department_id, default="Unknown"):
+        self._ensure_loaded()
+        key = str(department_id)
+        if key not in self._names and time.monotonic() - self._loaded_at > MISSING_ID_RELOAD_INTERVAL:
+            with self._lock:
+                if key not in self._names and time.monotonic() - self._loaded_at > MISSING_ID_RELOAD_INTERVAL:
+                    self._stats["misses"] += 1
+                    self._reload()
+        return self._names.get(key, default)
+
+    def invalidate(self):
+        with self._lock:
+            self._departments = None
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            "ttl": self.ttl,
+            "size": len(self._names),
+            "age": round(time.monotonic() - self._loaded_at, 1) if self._departments is not None else None,
+        })
+        return stats
+
+
+department_cache = DepartmentCache(DEPARTMENT_CACHE_TTL)
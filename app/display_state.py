@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+from app import queries
+from app.db import get_db_connection
+from app.department_cache import department_cache
+
+# Identifies this worker's sequence numbering; a client that sees a different
+# epoch (server restart, reconnect to another worker) asks for a snapshot.
+EPOCH = f"{os.getpid()}-{int(time.time() * 1000)}"
+
+# Fields of an 'update-token' event that make up what a display shows
+STATE_FIELDS = ("token", "name", "status")
+
+
+def fetch_current_tokens(department_ids=None):
+    """Current token of every department (or just ``department_ids``) in one query."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if department_ids is None:
+                queries.execute(cur, "current_tokens")
+            else:
+                queries.execute(cur, "current_tokens_for", {"department_ids": [str(d) for d in department_ids]})
+            rows = cur.fetchall()
+
+    return [
+        {
+            "department_id": department_id,
+            "department": department_cache.name(department_id),
+            "token": token_number,
+            "name": f"{first_name} {last_name}",
+            "patient_id": patient_id,
+            "status": status
+        }
+        for department_id, token_number, patient_id, status, first_name, last_name in rows
+    ]
+
+
+# ---------------- DISPLAY STATE ----------------
+class DisplayState:
+    """What every department's displays currently show, with a sequence number.
+
+    Each 'update-token' this worker emits is applied here and stamped with the
+    department's next ``seq``, so a display can tell when it missed one.
+    Departments are loaded from the database the first time a snapshot asks
+    for them (all missing ones in one query); after that snapshots are served
+    from memory, so a room full of screens reconnecting costs nothing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._departments = {}    # department_id -> {"seq", "token", "name", "status"}
+        self._stats = {"updates": 0, "snapshots": 0, "loads": 0}
+
+    def apply(self, department_id, data):
+        """Record an update; returns its sequence number.
+
+        An update about the token already shown changes only the fields it
+        carries (a re-announcement keeps the status); a different token
+        replaces the entry.
+        """
+        key = str(department_id)
+        with self._lock:
+            entry = self._departments.get(key)
+            seq = (entry["seq"] if entry else 0) + 1
+            if entry is not None and entry.get("token") == data.get("token"):
+                fields = {f: data[f] if f in data else entry.get(f) for f in STATE_FIELDS}
+            else:
+                fields = {f: data.get(f) for f in STATE_FIELDS}
+            self._departments[key] = dict(fields, seq=seq)
+            self._stats["updates"] += 1
+        return seq
+
+    def _load_missing(self, department_ids):
+        missing = [d for d in department_ids if d not in self._departments]
+        if not missing:
+            return
+        with self._load_lock:
+            missing = [d for d in missing if d not in self._departments]
+            if not missing:
+                return
+            current = {str(row["department_id"]): row for row in fetch_current_tokens(missing)}
+            self._stats["loads"] += 1
+            with self._lock:
+                for department_id in missing:
+                    # An update may have landed while the query ran; it is newer
+                    if department_id in self._departments:
+                        continue
+                    row = current.get(department_id, {})
+                    self._departments[department_id] = dict({f: row.get(f) for f in STATE_FIELDS}, seq=0)
+
+    def snapshot(self, department_ids):
+        department_ids = [str(d) for d in department_ids]
+        self._load_missing(department_ids)
+        with self._lock:
+            entries = [dict(self._departments[d], department_id=d) for d in department_ids]
+            self._stats["snapshots"] += 1
+        for entry in entries:
+            entry["department"] = department_cache.name(entry["department_id"], entry["department_id"])
+        return {"epoch": EPOCH, "departments": entries}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, departments=len(self._departments), epoch=EPOCH)
+
+
+display_state = DisplayState()
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import select
+import socket
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from app.db import get_db_connection
+from app_config import EVENT_BUS, EVENT_CHANNEL
+from db_config import DB_HOST, DB_NAME, DB_USER, DB_PASS
+
+# Sent by the specializations trigger (see README) to invalidate department caches
+SPECIALIZATIONS_CHANNEL = "specializations_changed"
+
+# NOTIFY payloads are limited to 8000 bytes by Postgres
+MAX_PAYLOAD = 7900
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+log = logging.getLogger(__name__)
+
+bus_stats = {"published": 0, "received": 0, "oversized": 0, "listener_reconnects": 0}
+
+
+def bus_enabled():
+    return EVENT_BUS == "postgres"
+
+
+# ---------------- PUBLISH ----------------
+def publish(event, data, department_id=None):
+    """Queue ``event`` for every worker; returns False if it must be emitted locally."""
+    payload = json.dumps({
+        "event": event,
+        "data": data,
+        "department_id": department_id,
+        "origin": WORKER_ID,
+    }, default=str)
+    if len(payload.encode("utf-8")) > MAX_PAYLOAD:
+        bus_stats["oversized"] += 1
+        return False
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_notify(%s, %s)", (EVENT_CHANNEL, payload))
+    bus_stats["published"] += 1
+    return True
+
+
+# ---------------- LISTEN ----------------
+def _dispatch(notify):
+    from app.realtime import emit_local
+    from app.department_cache import department_cache
+
+    if notify.channel == SPECIALIZATIONS_CHANNEL:
+        department_cache.invalidate()
+        return
+
+    try:
+        message = json.loads(notify.payload)
+    except ValueError:
+        log.warning("Ignoring malformed event bus payload", extra={"payload": notify.payload[:200]})
+        return
+    bus_stats["received"] += 1
+    emit_local(message["event"], message["data"], message.get("department_id"))
+
+
+def _listen_once():
+    conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+    try:
+        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{EVENT_CHANNEL}"')
+            cur.execute(f'LISTEN "{SPECIALIZATIONS_CHANNEL}"')
+        log.info("Listening for events", extra={"channel": EVENT_CHANNEL, "worker": WORKER_ID})
+
+        while True:
+            # select() is green under eventlet, so waiting here only parks this greenlet
+            if select.select([conn], [], [], 60) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                _dispatch(conn.notifies.pop(0))
+    finally:
+        conn.close()
+
+
+def listen_forever():
+    delay = 1
+    while True:
+        started = time.monotonic()
+        try:
+            _listen_once()
+        except Exception as e:
+            log.warning("Event bus listener failed: %s", e)
+        bus_stats["listener_reconnects"] += 1
+        # Back off while the database stays unreachable; reset after a healthy run
+        delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 30)
+        time.sleep(delay)
+
+
+def start_listener(socketio):
+    socketio.start_background_task(listen_forever)
@@ -0,0 +1,127 @@
+"""Idempotency-Key support: a retried request gets the first response instead of running again.
+
+A kiosk that loses its connection cannot tell whether /register went
+through, so it sends the same ``Idempotency-Key`` header with every retry.
+The first request with a key claims it in idempotency_keys (migration 9) and
+stores its response there; a retry within IDEMPOTENCY_WINDOW seconds gets
+that response back (with ``Idempotent-Replayed: true``) without creating a
+token or rendering a card. The table is shared, so this holds whichever
+worker the retry reaches.
+
+A retry that arrives while the first request is still running gets 409 with
+Retry-After; reusing a key with a different body gets 422. Server errors and
+rejected requests (429, 503) are not stored, so their retries run normally.
+A claim whose request never finished (crash, dead worker) is held only for
+IDEMPOTENCY_LEASE seconds, after which a retry takes the key over.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import jsonify, make_response, request, Response
+
+from app import queries
+from app.db import get_db_connection
+from app_config import IDEMPOTENCY_LEASE, IDEMPOTENCY_WINDOW
+
+log = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+# Expired keys are deleted at most this often per worker
+PRUNE_INTERVAL = 60
+
+idempotency_stats = {"claimed": 0, "replayed": 0, "in_progress": 0, "mismatched": 0}
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def _prune(cur):
+    global _last_prune
+    with _prune_lock:
+        if time.monotonic() - _last_prune < PRUNE_INTERVAL:
+            return
+        _last_prune = time.monotonic()
+    cur.execute("DELETE FROM idempotency_keys WHERE created_at < NOW() - make_interval(secs => %s)",
+                (IDEMPOTENCY_WINDOW,))
+
+
+def _claim(endpoint, key, request_hash, claim_id):
+    """``None`` if this request now owns the key, else ``(request_hash, status_code, response)``."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            queries.execute(cur, "idempotency_claim", {
+                "endpoint": endpoint, "key": key, "request_hash": request_hash, "claim_id": claim_id,
+                "window": IDEMPOTENCY_WINDOW, "lease": IDEMPOTENCY_LEASE,
+            })
+            row = cur.fetchone()
+            _prune(cur)
+    if row is None:
+        # Claimed by a request that committed after this one started
+        return (request_hash, None, None)
+    claimed, stored_hash, status_code, response = row
+    return None if claimed else (stored_hash, status_code, response)
+
+
+def _finish(endpoint, key, claim_id, response):
+    params = {"endpoint": endpoint, "key": key, "claim_id": claim_id}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if response is not None and response.status_code < 500 and response.status_code not in (409, 429):
+                queries.execute(cur, "idempotency_store", dict(
+                    params, status_code=response.status_code, response=response.get_data(as_text=True)))
+            else:
+                queries.execute(cur, "idempotency_release", params)
+
+
+def _error(message, status, retry_after=None):
+    response = jsonify({"error": message})
+    if retry_after:
+        response.headers["Retry-After"] = str(retry_after)
+    return response, status
+
+
+def idempotent(endpoint):
+    """Replay the stored response to requests that repeat an ``Idempotency-Key``."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key or IDEMPOTENCY_WINDOW <= 0:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error(f"{HEADER} is longer than {MAX_KEY_LENGTH} characters", 400)
+
+            request_hash = hashlib.sha256(request.get_data()).hexdigest()
+            claim_id = str(uuid.uuid4())
+            existing = _claim(endpoint, key, request_hash, claim_id)
+            if existing is not None:
+                stored_hash, status_code, body = existing
+                if stored_hash != request_hash:
+                    idempotency_stats["mismatched"] += 1
+                    return _error(f"{HEADER} was already used with a different request", 422)
+                if status_code is None:
+                    idempotency_stats["in_progress"] += 1
+                    return _error("A request with this key is still in progress", 409, retry_after=1)
+                idempotency_stats["replayed"] += 1
+                log.info("Replayed idempotent response", extra={"endpoint": endpoint, "status": status_code})
+                response = Response(body, status=status_code, mimetype="application/json")
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+
+            idempotency_stats["claimed"] += 1
+            response = None
+            try:
+                response = make_response(view(*args, **kwargs))
+                return response
+            finally:
+                try:
+                    _finish(endpoint, key, claim_id, response)
+                except Exception as e:
+                    log.warning("Storing idempotent response failed: %s", e, extra={"endpoint": endpoint})
+        return wrapper
+    return decorator
@@ -0,0 +1,166 @@
+"""Logging for the app: records are queued by the caller and written by a background thread.
+
+Modules log through ``logging.getLogger(__name__)`` and pass structured fields
+with ``extra`` (``department_id``, ``token``, ...); they end up as keys of the
+JSON line. A record with ``extra={"sample": "<key>"}`` is rate limited per key:
+at most LOG_SAMPLE_BURST such records per LOG_SAMPLE_INTERVAL seconds get
+through, and the next one that does carries the number suppressed meanwhile.
+
+    LOG_LEVEL=INFO
+    LOG_LEVELS=app.scan_api=DEBUG,app.realtime=WARNING
+    LOG_FORMAT=json        # or "text"
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+from datetime import datetime
+
+from app_config import (LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_QUEUE_SIZE,
+                        LOG_SAMPLE_BURST, LOG_SAMPLE_INTERVAL)
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+log_stats = {"dropped": 0, "sampled_out": 0}
+
+_listener = None
+_handler = None
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and not k.startswith("_")}
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """Let at most ``burst`` records per ``sample`` key through every ``interval`` seconds."""
+
+    def __init__(self, burst, interval):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}     # key -> [window_start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self._windows[key] = [now, 0, 0]
+            else:
+                suppressed = window[2]
+            if window[1] >= self.burst:
+                window[2] += 1
+                log_stats["sampled_out"] += 1
+                return False
+            window[1] += 1
+            window[2] = 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue the record as is; formatting happens on the writer thread."""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            # A full queue means the writer cannot keep up; drop rather than block
+            log_stats["dropped"] += 1
+
+
+def _original(module_name):
+    # Under eventlet the writer must be a real OS thread with a real queue, so
+    # a slow stdout never blocks the hub
+    import eventlet.patcher
+    if eventlet.patcher.is_monkey_patched("thread"):
+        return eventlet.patcher.original(module_name)
+    return __import__(module_name)
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(stream=None):
+    """Install the queue handler on the root logger; safe to call more than once."""
+    global _listener, _handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+        queue_module = _original("queue")
+        threading_module = _original("threading")
+
+        log_queue = queue_module.Queue(LOG_QUEUE_SIZE)
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+        handler = _QueueHandler(log_queue)
+        handler.addFilter(SampleFilter(LOG_SAMPLE_BURST, LOG_SAMPLE_INTERVAL))
+
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL.upper())
+        for name, level in _parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+
+        listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+        # QueueListener.start() uses the (possibly patched) threading module
+        listener._thread = thread = threading_module.Thread(target=listener._monitor, daemon=True,
+                                                            name="log-writer")
+        thread.start()
+        _listener, _handler = listener, handler
+        atexit.register(flush_logging)
+
+
+def flush_logging():
+    """Stop the writer thread after it has drained the queue; runs at exit."""
+    global _listener, _handler
+    with _configure_lock:
+        if _listener is not None:
+            logging.getLogger().removeHandler(_handler)
+            _listener.stop()
+            _listener, _handler = None, None
@@ -0,0 +1,292 @@
+"""Request, query and render instrumentation served in Prometheus text format at /metrics.
+
+Route latency is recorded around every request, SQL timing by the pooled
+connections in app/db.py (tagged with the function that ran the statement),
+and card/QR timing where they happen. Pool and Socket.IO counters that other
+modules already keep are read at scrape time.
+
+With SLOW_REQUEST_MS set, requests slower than that are logged together with
+the statements they ran.
+"""
+import bisect
+import logging
+import sys
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+
+from app_config import SLOW_REQUEST_MS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_collectors = []
+
+# Filled in by create_app: {"roles", "total_ms", "phases": {phase: ms}}
+startup_report = {}
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}     # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+def register_collector(collect):
+    """``collect()`` returns ``[(name, type, help, [(labels_dict, value), ...]), ...]`` at scrape time."""
+    _collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    for collect in _collectors:
+        try:
+            families = collect()
+        except Exception as e:
+            log.warning("Metrics collector %s failed: %s", getattr(collect, "__name__", collect), e)
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ---------------- METRICS ----------------
+http_request_duration = Histogram(
+    "regai_http_request_duration_seconds", "Request latency by route.", ["method", "route", "status"])
+db_query_duration = Histogram(
+    "regai_db_query_duration_seconds", "SQL statement latency by calling function.", ["caller", "statement"])
+card_render_duration = Histogram(
+    "regai_card_render_duration_seconds", "QR card (qrcode + PIL) render time, including the worker round trip.")
+card_render_failures = Counter(
+    "regai_card_render_failures_total", "QR card renders that raised.")
+qr_decode_duration = Histogram(
+    "regai_qr_decode_duration_seconds", "QR payload decode time by format.", ["format", "outcome"])
+
+
+# ---------------- SQL TIMING ----------------
+def _query_caller():
+    # Frames 0-2 are this function, observe_query() and the cursor's
+    # execute(); skip psycopg2 helpers such as execute_values and the
+    # statement catalog's execute() to reach the app function that ran it
+    frame = sys._getframe(3)
+    while frame is not None and (frame.f_globals.get("__name__", "").startswith("psycopg2")
+                                 or frame.f_globals.get("__name__") == "app.queries"):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+
+def _statement_kind(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    if not isinstance(query, str):
+        return "COMPOSED"
+    words = query.split(None, 1)
+    return words[0].upper() if words else ""
+
+
+def observe_query(query, elapsed, caller=None, statement=None):
+    """``statement`` names a catalog statement (app/queries.py); otherwise the SQL's first keyword is used."""
+    caller = caller or _query_caller()
+    statement = statement or _statement_kind(query)
+    db_query_duration.observe(elapsed, caller=caller, statement=statement)
+    if SLOW_REQUEST_MS and has_request_context():
+        queries = g.setdefault("metrics_queries", [])
+        queries.append((caller, statement, elapsed))
+
+
+# ---------------- REQUEST TIMING ----------------
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    http_request_duration.observe(elapsed, method=request.method, route=route, status=response.status_code)
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        queries = g.pop("metrics_queries", [])
+        log.warning("Slow request", extra={
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "ms": round(elapsed * 1000, 1),
+            "db_ms": round(sum(q[2] for q in queries) * 1000, 1),
+            "queries": [
+                {"caller": caller, "statement": statement, "ms": round(q_elapsed * 1000, 2)}
+                for caller, statement, q_elapsed in queries
+            ],
+        })
+    return response
+
+
+def _metrics_view():
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------- COLLECTORS ----------------
+def _collect_pool():
+    from app.db import pool_stats
+
+    stats = pool_stats()
+    return [
+        ("regai_db_connections_opened_total", "counter", "Database connections opened by the pool.",
+         [({}, stats["connections_opened"])]),
+        ("regai_db_connections_closed_total", "counter", "Database connections closed by the pool.",
+         [({}, stats["connections_closed"])]),
+        ("regai_db_pool_connections", "gauge", "Pooled connections by state.",
+         [({"state": "idle"}, stats["idle"]), ({"state": "in_use"}, stats["in_use"])]),
+        ("regai_db_pool_checkouts_total", "counter", "Connections handed out by the pool.",
+         [({}, stats["checkouts"])]),
+        ("regai_db_pool_waits_total", "counter", "Checkouts that had to wait for a free connection.",
+         [({}, stats["waits"])]),
+        ("regai_db_pool_timeouts_total", "counter", "Checkouts that gave up waiting.",
+         [({}, stats["timeouts"])]),
+        ("regai_db_round_trips_total", "counter", "Statements, commits and rollbacks sent to the server.",
+         [({"kind": kind}, stats["round_trips"][kind]) for kind in ("statements", "commits", "rollbacks")]),
+    ]
+
+
+def _collect_emits():
+    from app.realtime import emit_stats
+    from app.throttle import debouncer
+
+    limited = debouncer.stats()
+    return [
+        ("regai_socketio_emits_total", "counter", "Socket.IO events emitted by this worker.",
+         [({}, emit_stats["emits"])]),
+        ("regai_socketio_emit_failures_total", "counter", "Socket.IO emits that raised.",
+         [({}, emit_stats["failures"])]),
+        ("regai_socketio_deliveries_total", "counter", "Clients reached by Socket.IO emits.",
+         [({}, emit_stats["deliveries"])]),
+        ("regai_socketio_emits_coalesced_total", "counter", "Token updates superseded within the coalescing window.",
+         [({}, emit_stats["coalesced"])]),
+        ("regai_rate_limited_requests_total", "counter", "Requests rejected with 429 by the per-department debounce.",
+         [({"endpoint": name}, stats["limited"]) for name, stats in sorted(limited.items())]),
+    ]
+
+
+def _collect_logging():
+    from app.log import log_stats
+
+    return [
+        ("regai_log_records_dropped_total", "counter", "Log records dropped because the log queue was full.",
+         [({}, log_stats["dropped"])]),
+        ("regai_log_records_sampled_out_total", "counter", "Repetitive log records suppressed by sampling.",
+         [({}, log_stats["sampled_out"])]),
+    ]
+
+
+def _collect_admission():
+    # Only processes serving the registration role load token_api
+    token_api = sys.modules.get("app.token_api")
+    if token_api is None:
+        return []
+    from app.idempotency import idempotency_stats
+
+    stats = token_api.register_admission.stats()
+    return [
+        ("regai_admission_queue_depth", "gauge", "Registrations waiting for a slot.",
+         [({"endpoint": "register"}, stats["waiting"])]),
+        ("regai_admission_in_flight", "gauge", "Registrations holding a slot.",
+         [({"endpoint": "register"}, stats["running"])]),
+        ("regai_admission_admitted_total", "counter", "Registrations given a slot.",
+         [({"endpoint": "register"}, stats["admitted"])]),
+        ("regai_admission_rejected_total", "counter", "Registrations turned away with 503, by reason.",
+         [({"endpoint": "register", "reason": "queue_full"}, stats["rejected_full"]),
+          ({"endpoint": "register", "reason": "timeout"}, stats["rejected_timeout"])]),
+        ("regai_idempotent_requests_total", "counter", "Requests sent with an Idempotency-Key, by outcome.",
+         [({"outcome": outcome}, count) for outcome, count in sorted(idempotency_stats.items())]),
+    ]
+
+
+def _collect_startup():
+    if not startup_report:
+        return []
+    return [
+        ("regai_startup_seconds", "gauge", "Time create_app took, by step.",
+         [({"phase": phase}, ms / 1000) for phase, ms in startup_report["phases"].items()]),
+    ]
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", _metrics_view, methods=["GET"])
+    for collect in (_collect_pool, _collect_emits, _collect_logging, _collect_admission, _collect_startup):
+        if collect not in _collectors:
+            register_collector(collect)
@@ -0,0 +1,618 @@
+"""Versioned schema migrations.
+
+    python -m app.migrations status   # list applied / pending migrations
+    python -m app.migrations apply    # apply pending migrations
+    python -m app.migrations check    # EXPLAIN the hot queries, fail unless each uses its index
+
+Set AUTO_MIGRATE=1 to apply pending migrations when the app starts.
+"""
+import json
+import logging
+import sys
+from datetime import date, datetime, timedelta
+
+from app.db import get_db_connection
+from app.queries import CATALOG
+
+log = logging.getLogger(__name__)
+
+# Held while migrating so several workers starting together apply each step once
+MIGRATION_LOCK_ID = 7264001
+
+# Each migration runs in one transaction unless "transaction" is False (needed
+# for CREATE INDEX CONCURRENTLY, which keeps patient_tokens writable while the
+# index builds).
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "baseline token tables",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS patient_tokens (
+                token UUID PRIMARY KEY,
+                id INTEGER NOT NULL,
+                patient_id VARCHAR(50) NOT NULL,
+                department_id VARCHAR(50) NOT NULL,
+                datetime TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                status VARCHAR(20) DEFAULT 'waiting',
+                status_updated_at TIMESTAMP DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS current_token (
+                id SERIAL PRIMARY KEY,
+                token_uuid UUID NOT NULL,
+                token_number INTEGER NOT NULL,
+                patient_id VARCHAR(255) NOT NULL,
+                department_id VARCHAR(50) NOT NULL,
+                updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+                CONSTRAINT unique_department UNIQUE (department_id)
+            )
+            """,
+            # Older installs created current_token without the unique
+            # constraint that call-next's upsert relies on
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conrelid = 'current_token'::regclass AND contype IN ('u', 'p')
+                      AND conkey = ARRAY[(SELECT attnum FROM pg_attribute
+                                          WHERE attrelid = 'current_token'::regclass
+                                            AND attname = 'department_id')]
+                ) THEN
+                    ALTER TABLE current_token ADD CONSTRAINT unique_department UNIQUE (department_id);
+                END IF;
+            END $$
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "name": "daily token counters",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS token_counters (
+                department_id VARCHAR(50) NOT NULL,
+                day DATE NOT NULL,
+                last_value INTEGER NOT NULL,
+                PRIMARY KEY (department_id, day)
+            )
+            """,
+        ],
+    },
+    {
+        "version": 3,
+        "name": "queue indexes",
+        "transaction": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS patient_tokens_department_datetime_idx
+            ON patient_tokens (department_id, datetime)
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS patient_tokens_department_status_idx
+            ON patient_tokens (department_id, status, status_updated_at)
+            """,
+        ],
+    },
+    {
+        "version": 4,
+        "name": "specializations change notification",
+        "statements": [
+            """
+            CREATE OR REPLACE FUNCTION notify_specializations_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('specializations_changed', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            DO $$
+            BEGIN
+                IF to_regclass('specializations') IS NOT NULL THEN
+                    DROP TRIGGER IF EXISTS specializations_changed ON specializations;
+                    CREATE TRIGGER specializations_changed
+                    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON specializations
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_specializations_changed();
+                END IF;
+            END $$
+            """,
+        ],
+    },
+    {
+        "version": 5,
+        "name": "queue change cursor index",
+        "transaction": False,
+        "statements": [
+            # Serves /queue/<id>?since=<cursor>, which walks a department's
+            # rows in (status_updated_at, token) order
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS patient_tokens_department_updated_idx
+            ON patient_tokens (department_id, status_updated_at, token)
+            """,
+        ],
+    },
+    {
+        "version": 6,
+        "name": "daily patient_tokens partitions",
+        "statements": [
+            # One partition per registration day (app/partitions.py creates
+            # them ahead and archives expired ones). Rows for a day without a
+            # partition land in patient_tokens_default until it is created.
+            """
+            CREATE OR REPLACE FUNCTION ensure_token_partition(day DATE) RETURNS BOOLEAN AS $$
+            DECLARE
+                part TEXT := 'patient_tokens_p' || to_char(day, 'YYYYMMDD');
+            BEGIN
+                IF to_regclass(part) IS NOT NULL THEN
+                    RETURN FALSE;
+                END IF;
+                IF EXISTS (SELECT 1 FROM patient_tokens_default
+                           WHERE datetime >= day AND datetime < day + 1) THEN
+                    -- A partition cannot be created over rows in the default one; move them
+                    EXECUTE format('CREATE TABLE %I (LIKE patient_tokens INCLUDING DEFAULTS)', part);
+                    EXECUTE format('WITH moved AS (DELETE FROM patient_tokens_default
+                                                   WHERE datetime >= %L AND datetime < %L RETURNING *)
+                                    INSERT INTO %I SELECT * FROM moved', day, day + 1, part);
+                    EXECUTE format('ALTER TABLE patient_tokens ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                                   part, day, day + 1);
+                ELSE
+                    EXECUTE format('CREATE TABLE %I PARTITION OF patient_tokens FOR VALUES FROM (%L) TO (%L)',
+                                   part, day, day + 1);
+                END IF;
+                RETURN TRUE;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "ALTER TABLE patient_tokens RENAME TO patient_tokens_unpartitioned",
+            "ALTER INDEX IF EXISTS patient_tokens_pkey RENAME TO patient_tokens_unpartitioned_pkey",
+            # The partition key has to be part of the primary key
+            """
+            CREATE TABLE patient_tokens (
+                token UUID NOT NULL,
+                id INTEGER NOT NULL,
+                patient_id VARCHAR(50) NOT NULL,
+                department_id VARCHAR(50) NOT NULL,
+                datetime TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                status VARCHAR(20) DEFAULT 'waiting',
+                status_updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (token, datetime)
+            ) PARTITION BY RANGE (datetime)
+            """,
+            "CREATE TABLE patient_tokens_default PARTITION OF patient_tokens DEFAULT",
+            """
+            SELECT ensure_token_partition(day::date)
+            FROM (SELECT DISTINCT datetime::date AS day FROM patient_tokens_unpartitioned
+                  UNION
+                  SELECT generate_series(CURRENT_DATE, CURRENT_DATE + 7, interval '1 day')::date) days
+            ORDER BY day
+            """,
+            """
+            INSERT INTO patient_tokens
+                (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
+            SELECT token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at
+            FROM patient_tokens_unpartitioned
+            """,
+            "DROP TABLE patient_tokens_unpartitioned",
+            # Same indexes as migrations 3 and 5, now created on every partition
+            "CREATE INDEX patient_tokens_department_datetime_idx ON patient_tokens (department_id, datetime)",
+            """
+            CREATE INDEX patient_tokens_department_status_idx
+            ON patient_tokens (department_id, status, status_updated_at)
+            """,
+            """
+            CREATE INDEX patient_tokens_department_updated_idx
+            ON patient_tokens (department_id, status_updated_at, token)
+            """,
+            # Expired partitions are detached from patient_tokens and attached here
+            """
+            CREATE TABLE IF NOT EXISTS patient_tokens_archive (
+                LIKE patient_tokens INCLUDING DEFAULTS,
+                PRIMARY KEY (token, datetime)
+            ) PARTITION BY RANGE (datetime)
+            """,
+        ],
+    },
+    {
+        "version": 7,
+        "name": "open tokens by expiry",
+        "statements": [
+            # Lets the no-show sweep (app/sweeper.py) find expired open tokens
+            # without scanning; only tokens still queued are indexed
+            """
+            CREATE INDEX IF NOT EXISTS patient_tokens_open_expires_idx
+            ON patient_tokens (expires_at) WHERE status IN ('waiting', 'recall', 'hold')
+            """,
+        ],
+    },
+    {
+        "version": 8,
+        "name": "queue statistics",
+        "statements": [
+            # Tokens per status for each department and registration day, and
+            # a moving average of consulting -> completed durations; kept
+            # current by the trigger below (app/queue_stats.py reads it)
+            """
+            CREATE TABLE IF NOT EXISTS queue_stats (
+                department_id VARCHAR(50) NOT NULL,
+                day DATE NOT NULL,
+                waiting INTEGER NOT NULL DEFAULT 0,
+                consulting INTEGER NOT NULL DEFAULT 0,
+                recall INTEGER NOT NULL DEFAULT 0,
+                hold INTEGER NOT NULL DEFAULT 0,
+                no_show INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                consult_count INTEGER NOT NULL DEFAULT 0,
+                consult_avg_seconds DOUBLE PRECISION,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (department_id, day)
+            )
+            """,
+            # Each new sample moves the average a fifth of the way towards it,
+            # so it follows roughly the last ten consults
+            """
+            CREATE OR REPLACE FUNCTION queue_stats_apply() RETURNS TRIGGER AS $$
+            DECLARE
+                old_status TEXT;
+                consult DOUBLE PRECISION;
+            BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                    IF OLD.status IS NOT DISTINCT FROM NEW.status THEN
+                        RETURN NULL;
+                    END IF;
+                    old_status := OLD.status;
+                    IF OLD.status = 'consulting' AND NEW.status = 'completed' THEN
+                        consult := GREATEST(EXTRACT(EPOCH FROM NEW.status_updated_at - OLD.status_updated_at), 0);
+                    END IF;
+                END IF;
+
+                INSERT INTO queue_stats AS s (department_id, day, waiting, consulting, recall, hold, no_show, completed,
+                                              consult_count, consult_avg_seconds)
+                VALUES (NEW.department_id, NEW.datetime::date,
+                        (NEW.status = 'waiting')::int - COALESCE((old_status = 'waiting')::int, 0),
+                        (NEW.status = 'consulting')::int - COALESCE((old_status = 'consulting')::int, 0),
+                        (NEW.status = 'recall')::int - COALESCE((old_status = 'recall')::int, 0),
+                        (NEW.status = 'hold')::int - COALESCE((old_status = 'hold')::int, 0),
+                        (NEW.status = 'no_show')::int - COALESCE((old_status = 'no_show')::int, 0),
+                        (NEW.status = 'completed')::int - COALESCE((old_status = 'completed')::int, 0),
+                        (consult IS NOT NULL)::int, consult)
+                ON CONFLICT (department_id, day) DO UPDATE SET
+                    waiting = s.waiting + EXCLUDED.waiting,
+                    consulting = s.consulting + EXCLUDED.consulting,
+                    recall = s.recall + EXCLUDED.recall,
+                    hold = s.hold + EXCLUDED.hold,
+                    no_show = s.no_show + EXCLUDED.no_show,
+                    completed = s.completed + EXCLUDED.completed,
+                    consult_count = s.consult_count + EXCLUDED.consult_count,
+                    consult_avg_seconds = CASE
+                        WHEN consult IS NULL THEN s.consult_avg_seconds
+                        WHEN s.consult_avg_seconds IS NULL THEN consult
+                        ELSE s.consult_avg_seconds + 0.2 * (consult - s.consult_avg_seconds)
+                    END,
+                    updated_at = NOW();
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            # Rows moved between partitions by ensure_token_partition are
+            # deleted and inserted into a table not yet attached, so neither
+            # side fires this
+            """
+            CREATE TRIGGER patient_tokens_queue_stats
+            AFTER INSERT OR UPDATE OF status ON patient_tokens
+            FOR EACH ROW EXECUTE FUNCTION queue_stats_apply()
+            """,
+            """
+            INSERT INTO queue_stats (department_id, day, waiting, consulting, recall, hold, no_show, completed)
+            SELECT department_id, datetime::date,
+                   count(*) FILTER (WHERE status = 'waiting'),
+                   count(*) FILTER (WHERE status = 'consulting'),
+                   count(*) FILTER (WHERE status = 'recall'),
+                   count(*) FILTER (WHERE status = 'hold'),
+                   count(*) FILTER (WHERE status = 'no_show'),
+                   count(*) FILTER (WHERE status = 'completed')
+            FROM patient_tokens
+            GROUP BY department_id, datetime::date
+            ON CONFLICT (department_id, day) DO NOTHING
+            """,
+        ],
+    },
+    {
+        "version": 9,
+        "name": "idempotency keys",
+        "statements": [
+            # Responses to requests sent with an Idempotency-Key
+            # (app/idempotency.py); status_code is NULL while the first
+            # request with the key is still running
+            """
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                endpoint VARCHAR(50) NOT NULL,
+                key VARCHAR(255) NOT NULL,
+                request_hash CHAR(64) NOT NULL,
+                status_code INTEGER,
+                response TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (endpoint, key)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON idempotency_keys (created_at)",
+        ],
+    },
+    {
+        "version": 10,
+        "name": "idempotency claim lease",
+        "statements": [
+            # Which request holds an unfinished key and since when, so a
+            # claim left behind by a crashed request can be taken over
+            """
+            ALTER TABLE idempotency_keys
+                ADD COLUMN IF NOT EXISTS claim_id UUID,
+                ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP NOT NULL DEFAULT NOW()
+            """,
+        ],
+    },
+    {
+        "version": 11,
+        "name": "queue statistics on delete",
+        "statements": [
+            # Deleted tokens leave their department's counters too. Rows
+            # ensure_token_partition moves out of patient_tokens_default are
+            # deleted but re-inserted into a table not yet attached, so the
+            # move marks itself and the trigger leaves those alone.
+            """
+            CREATE OR REPLACE FUNCTION queue_stats_apply() RETURNS TRIGGER AS $$
+            DECLARE
+                token_department TEXT;
+                token_day DATE;
+                new_status TEXT;
+                old_status TEXT;
+                consult DOUBLE PRECISION;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    IF current_setting('queue_stats.moving', true) = 'on' THEN
+                        RETURN NULL;
+                    END IF;
+                    token_department := OLD.department_id;
+                    token_day := OLD.datetime::date;
+                    old_status := OLD.status;
+                ELSE
+                    IF TG_OP = 'UPDATE' THEN
+                        IF OLD.status IS NOT DISTINCT FROM NEW.status THEN
+                            RETURN NULL;
+                        END IF;
+                        old_status := OLD.status;
+                        IF OLD.status = 'consulting' AND NEW.status = 'completed' THEN
+                            consult := GREATEST(EXTRACT(EPOCH FROM NEW.status_updated_at - OLD.status_updated_at), 0);
+                        END IF;
+                    END IF;
+                    token_department := NEW.department_id;
+                    token_day := NEW.datetime::date;
+                    new_status := NEW.status;
+                END IF;
+
+                INSERT INTO queue_stats AS s (department_id, day, waiting, consulting, recall, hold, no_show, completed,
+                                              consult_count, consult_avg_seconds)
+                VALUES (token_department, token_day,
+                        COALESCE((new_status = 'waiting')::int, 0) - COALESCE((old_status = 'waiting')::int, 0),
+                        COALESCE((new_status = 'consulting')::int, 0) - COALESCE((old_status = 'consulting')::int, 0),
+                        COALESCE((new_status = 'recall')::int, 0) - COALESCE((old_status = 'recall')::int, 0),
+                        COALESCE((new_status = 'hold')::int, 0) - COALESCE((old_status = 'hold')::int, 0),
+                        COALESCE((new_status = 'no_show')::int, 0) - COALESCE((old_status = 'no_show')::int, 0),
+                        COALESCE((new_status = 'completed')::int, 0) - COALESCE((old_status = 'completed')::int, 0),
+                        (consult IS NOT NULL)::int, consult)
+                ON CONFLICT (department_id, day) DO UPDATE SET
+                    waiting = s.waiting + EXCLUDED.waiting,
+                    consulting = s.consulting + EXCLUDED.consulting,
+                    recall = s.recall + EXCLUDED.recall,
+                    hold = s.hold + EXCLUDED.hold,
+                    no_show = s.no_show + EXCLUDED.no_show,
+                    completed = s.completed + EXCLUDED.completed,
+                    consult_count = s.consult_count + EXCLUDED.consult_count,
+                    consult_avg_seconds = CASE
+                        WHEN consult IS NULL THEN s.consult_avg_seconds
+                        WHEN s.consult_avg_seconds IS NULL THEN consult
+                        ELSE s.consult_avg_seconds + 0.2 * (consult - s.consult_avg_seconds)
+                    END,
+                    updated_at = NOW();
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION ensure_token_partition(day DATE) RETURNS BOOLEAN AS $$
+            DECLARE
+                part TEXT := 'patient_tokens_p' || to_char(day, 'YYYYMMDD');
+            BEGIN
+                IF to_regclass(part) IS NOT NULL THEN
+                    RETURN FALSE;
+                END IF;
+                IF EXISTS (SELECT 1 FROM patient_tokens_default
+                           WHERE datetime >= day AND datetime < day + 1) THEN
+                    -- A partition cannot be created over rows in the default one; move them
+                    EXECUTE format('CREATE TABLE %I (LIKE patient_tokens INCLUDING DEFAULTS)', part);
+                    PERFORM set_config('queue_stats.moving', 'on', true);
+                    EXECUTE format('WITH moved AS (DELETE FROM patient_tokens_default
+                                                   WHERE datetime >= %L AND datetime < %L RETURNING *)
+                                    INSERT INTO %I SELECT * FROM moved', day, day + 1, part);
+                    PERFORM set_config('queue_stats.moving', 'off', true);
+                    EXECUTE format('ALTER TABLE patient_tokens ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                                   part, day, day + 1);
+                ELSE
+                    EXECUTE format('CREATE TABLE %I PARTITION OF patient_tokens FOR VALUES FROM (%L) TO (%L)',
+                                   part, day, day + 1);
+                END IF;
+                RETURN TRUE;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS patient_tokens_queue_stats ON patient_tokens",
+            """
+            CREATE TRIGGER patient_tokens_queue_stats
+            AFTER INSERT OR UPDATE OF status OR DELETE ON patient_tokens
+            FOR EACH ROW EXECUTE FUNCTION queue_stats_apply()
+            """,
+        ],
+    },
+]
+
+
+# ---------------- APPLY ----------------
+def _ensure_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+def applied_versions():
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            _ensure_table(cur)
+            cur.execute("SELECT version FROM schema_migrations")
+            return {row[0] for row in cur.fetchall()}
+
+
+def apply_migrations():
+    """Apply pending migrations in version order; returns the versions applied."""
+    applied = []
+    with get_db_connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                try:
+                    _ensure_table(cur)
+                    cur.execute("SELECT version FROM schema_migrations")
+                    done = {row[0] for row in cur.fetchall()}
+
+                    for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+                        if migration["version"] in done:
+                            continue
+                        log.info("Applying migration %s: %s", migration["version"], migration["name"])
+                        transactional = migration.get("transaction", True)
+                        if transactional:
+                            cur.execute("BEGIN")
+                        try:
+                            for statement in migration["statements"]:
+                                cur.execute(statement)
+                            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                                        (migration["version"], migration["name"]))
+                            if transactional:
+                                cur.execute("COMMIT")
+                        except Exception:
+                            if transactional:
+                                cur.execute("ROLLBACK")
+                            raise
+                        applied.append(migration["version"])
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        finally:
+            conn.autocommit = False
+    return applied
+
+
+# ---------------- INDEX CHECK ----------------
+def _hot_queries(department_id="1"):
+    """The hot catalog statements with sample parameters and the indexes (any one) each must use."""
+    day_start = datetime.combine(date.today(), datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    day = {"department_id": department_id, "day_start": day_start, "day_end": day_end}
+    # Partitions hold one day each, so a day's rows of a department are served
+    # equally well by any index leading with department_id
+    department_indexes = ("patient_tokens_department_datetime_idx", "patient_tokens_department_status_idx",
+                          "patient_tokens_department_updated_idx")
+    samples = {
+        "queue_rows": (day, department_indexes),
+        # A display polling for the last minute's changes
+        "queue_changes": (dict(day, since_at=datetime.now() - timedelta(minutes=1),
+                               since_token="00000000-0000-0000-0000-000000000000", limit=501),
+                          ("patient_tokens_department_updated_idx",)),
+        # A candidate plans both the proposal's probes and the priority scan
+        "call_next": ({"department_id": department_id, "candidate": "00000000-0000-0000-0000-000000000000",
+                       "candidate_status": "waiting"}, ("patient_tokens_department_status_idx",)),
+        "seed_token_counter": (dict(day, day=day_start.date(), count=1), department_indexes),
+        "sweep_expired": ({"batch_size": 500}, ("patient_tokens_open_expires_idx",)),
+    }
+    return {name: (CATALOG[name].sql, params, indexes) for name, (params, indexes) in samples.items()}
+
+
+def _index_names(plan):
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        names |= _index_names(child)
+    return names
+
+
+def _parent_indexes(cur, names):
+    # patient_tokens is partitioned, so its plans name the partitions' indexes;
+    # map each to the index it was created from on patient_tokens
+    cur.execute("""
+        SELECT c.relname, COALESCE(p.relname, c.relname)
+        FROM pg_class c
+        LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+        LEFT JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relkind IN ('i', 'I') AND c.relname = ANY(%s)
+    """, (list(names),))
+    return {parent for _, parent in cur.fetchall()}
+
+
+def check_index_usage(queries=None):
+    """EXPLAIN each hot query with sequential scans discouraged.
+
+    Returns ``{name: plan_uses_an_expected_index}``. Seq scans are disabled so the
+    result reflects whether the index *can* serve the query, independent of
+    how small the table currently is; naming the index keeps a scan of some
+    other index (e.g. the primary key) from passing for it.
+    """
+    results = {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if queries is None:
+                # Plans follow the statistics, so sample a department that has a queue today
+                cur.execute("""
+                    SELECT department_id FROM patient_tokens
+                    WHERE datetime >= CURRENT_DATE AND datetime < CURRENT_DATE + 1
+                    GROUP BY department_id ORDER BY count(*) DESC LIMIT 1
+                """)
+                row = cur.fetchone()
+                queries = _hot_queries(row[0] if row else "1")
+            cur.execute("SET LOCAL enable_seqscan = off")
+            for name, (sql, params, indexes) in queries.items():
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0][0]["Plan"]
+                results[name] = bool(set(indexes) & _parent_indexes(cur, _index_names(plan)))
+        conn.rollback()
+    return results
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "status"
+    if command == "apply":
+        applied = apply_migrations()
+        print(f"Applied: {applied}" if applied else "Schema is up to date")
+    elif command == "status":
+        done = applied_versions()
+        for migration in MIGRATIONS:
+            state = "applied" if migration["version"] in done else "pending"
+            print(f"{migration['version']:>4}  {state:<8} {migration['name']}")
+    elif command == "check":
+        results = check_index_usage()
+        print(json.dumps(results, indent=2))
+        return 0 if all(results.values()) else 1
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    from app.log import configure_logging
+    configure_logging()
+    sys.exit(main(sys.argv))
@@ -0,0 +1,193 @@
+"""Daily partitions of patient_tokens: created ahead of time, archived once expired.
+
+    python -m app.partitions status                # list partitions and their row counts
+    python -m app.partitions ensure                # create the next PARTITION_DAYS_AHEAD days
+    python -m app.partitions archive [--dir DIR]   # move expired partitions out of patient_tokens
+
+A token expires a day after it was issued, so a day's partition is expired
+once the day after it has ended too. Archiving detaches it from patient_tokens
+and attaches it to patient_tokens_archive (no rows are copied), or with
+``--dir`` / PARTITION_ARCHIVE_DIR writes it to ``patient_tokens_<day>.csv.gz``
+and drops it. The app runs ``ensure`` and ``archive`` every
+PARTITION_MAINTENANCE_INTERVAL seconds, and deletes the cards of expired
+tokens from CARD_CACHE_DIR.
+"""
+import gzip
+import logging
+import os
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from app.db import get_db_connection
+from app_config import PARTITION_DAYS_AHEAD, PARTITION_ARCHIVE_DIR, PARTITION_MAINTENANCE_INTERVAL
+
+log = logging.getLogger(__name__)
+
+# Held while creating or archiving so several workers do not collide
+PARTITION_LOCK_ID = 7264002
+
+PARTITION_NAME = re.compile(r"^patient_tokens_p(\d{8})$")
+
+PARTITIONS_SQL = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = %s::regclass
+    ORDER BY c.relname
+"""
+
+
+def _partition_day(name):
+    match = PARTITION_NAME.match(name)
+    return datetime.strptime(match.group(1), "%Y%m%d").date() if match else None
+
+
+def list_partitions(cur, parent="patient_tokens"):
+    """``[(name, day)]``; the default partition's day is None."""
+    cur.execute(PARTITIONS_SQL, (parent,))
+    return [(name, _partition_day(name)) for (name,) in cur.fetchall()]
+
+
+def _try_lock(cur):
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+    return cur.fetchone()[0]
+
+
+# ---------------- CREATE AHEAD ----------------
+def ensure_partitions(days_ahead=PARTITION_DAYS_AHEAD, today=None):
+    """Create partitions for today and the next ``days_ahead`` days; returns the days created."""
+    today = today or date.today()
+    created = []
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if not _try_lock(cur):
+                return created
+            for offset in range(days_ahead + 1):
+                day = today + timedelta(days=offset)
+                cur.execute("SELECT ensure_token_partition(%s)", (day,))
+                if cur.fetchone()[0]:
+                    created.append(day)
+    for day in created:
+        log.info("Created patient_tokens partition", extra={"day": day.isoformat()})
+    return created
+
+
+# ---------------- ARCHIVE ----------------
+def _archive_to_file(cur, name, day, directory):
+    path = os.path.join(directory, f"patient_tokens_{day.isoformat()}.csv.gz")
+    partial = path + ".partial"
+    with gzip.open(partial, "wb") as f:
+        cur.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', f)
+    os.replace(partial, path)
+    cur.execute(f'DROP TABLE "{name}"')
+    return path
+
+
+def archive_expired(directory=None, today=None, dry_run=False):
+    """Detach partitions whose tokens have all expired; returns ``[(day, destination)]``.
+
+    Each partition is archived in its own transaction, so a failure leaves the
+    ones before it archived and the rest in place.
+    """
+    today = today or date.today()
+    # Tokens issued on day D expire before D + 2
+    cutoff = today - timedelta(days=1)
+    archived = []
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if not _try_lock(cur):
+                return archived
+            # Rows registered for a day that never had a partition sit in the
+            # default one; give them theirs so they are archived with it
+            cur.execute("SELECT DISTINCT datetime::date FROM patient_tokens_default WHERE datetime < %s",
+                        (cutoff,))
+            stray_days = [day for (day,) in cur.fetchall()]
+            if dry_run:
+                expired = [("patient_tokens_default", day) for day in stray_days]
+            else:
+                expired = []
+                for day in stray_days:
+                    cur.execute("SELECT ensure_token_partition(%s)", (day,))
+            expired += [(name, day) for name, day in list_partitions(cur) if day is not None and day < cutoff]
+
+    for name, day in expired:
+        if dry_run:
+            archived.append((day, name))
+            continue
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if not _try_lock(cur):
+                    break
+                # DETACH briefly locks patient_tokens; give up rather than queue
+                # every request behind a long-running query
+                cur.execute("SET LOCAL lock_timeout = '5s'")
+                cur.execute(f'ALTER TABLE patient_tokens DETACH PARTITION "{name}"')
+                if directory:
+                    destination = _archive_to_file(cur, name, day, directory)
+                else:
+                    cur.execute(f'ALTER TABLE patient_tokens_archive ATTACH PARTITION "{name}" '
+                                "FOR VALUES FROM (%s) TO (%s)", (day, day + timedelta(days=1)))
+                    destination = "patient_tokens_archive"
+        archived.append((day, destination))
+        log.info("Archived patient_tokens partition", extra={"day": day.isoformat(), "to": destination})
+    return archived
+
+
+# ---------------- BACKGROUND JOB ----------------
+def run_maintenance():
+    ensure_partitions()
+    archive_expired(PARTITION_ARCHIVE_DIR)
+    # Cards are cached per token; once the token expires its file is dead weight
+    from app.card_render import card_cache
+    removed = card_cache.prune()
+    if removed:
+        log.info("Pruned expired QR cards", extra={"count": removed})
+
+
+def maintain_forever(interval=PARTITION_MAINTENANCE_INTERVAL):
+    while True:
+        try:
+            run_maintenance()
+        except Exception as e:
+            log.warning("Partition maintenance failed: %s", e)
+        time.sleep(interval)
+
+
+def start_maintenance(socketio):
+    if PARTITION_MAINTENANCE_INTERVAL > 0:
+        socketio.start_background_task(maintain_forever)
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "status"
+    if command == "status":
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                for parent in ("patient_tokens", "patient_tokens_archive"):
+                    for name, day in list_partitions(cur, parent):
+                        cur.execute(f'SELECT count(*) FROM "{name}"')
+                        print(f"{parent:<24} {name:<32} {cur.fetchone()[0]} rows")
+    elif command == "ensure":
+        created = ensure_partitions()
+        print(f"Created: {[d.isoformat() for d in created]}" if created else "Partitions are in place")
+    elif command == "archive":
+        args = argv[2:]
+        directory = args[args.index("--dir") + 1] if "--dir" in args else PARTITION_ARCHIVE_DIR
+        archived = archive_expired(directory, dry_run="--dry-run" in args)
+        for day, destination in archived:
+            print(f"{day.isoformat()}  {destination}")
+        if not archived:
+            print("Nothing to archive")
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    from app.log import configure_logging
+    configure_logging()
+    sys.exit(main(sys.argv))
@@ -0,0 +1,431 @@
+"""Central catalog of the hot SQL statements, PREPAREd once per pooled connection.
+
+Each statement is written once here with named ``%(param)s`` placeholders and
+a Postgres type per parameter. ``execute(cur, name, params)`` sends
+``PREPARE`` together with the first ``EXECUTE`` on a connection (still one
+round trip) and only ``EXECUTE`` afterwards, so the server parses and plans
+the statement once per connection instead of on every call. Set
+PREPARED_STATEMENTS=0 to send the plain SQL instead (e.g. behind a pooler in
+transaction mode, where session state does not survive between transactions).
+
+Rows come back as tuples; ``fetch_dicts`` zips them with the column names
+where a dict is wanted, which is cheaper than RealDictCursor's row objects.
+"""
+import re
+
+from app_config import PREPARED_STATEMENTS
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+statement_stats = {"prepares": 0, "executions": 0, "inline": 0}
+
+
+class Statement:
+    def __init__(self, name, sql, params):
+        self.name = name
+        self.sql = sql
+        self.param_names = [p for p, _ in params]
+        positions = {p: i + 1 for i, p in enumerate(self.param_names)}
+        # Still sent through cur.execute() with params, so "%%" stays escaped
+        body = _PLACEHOLDER.sub(lambda m: f"${positions[m.group(1)]}", sql)
+        types = ", ".join(t for _, t in params)
+        self.prepare_sql = f"PREPARE {name} ({types}) AS {body}" if params else f"PREPARE {name} AS {body}"
+        args = ", ".join(f"%({p})s" for p in self.param_names)
+        self.execute_sql = f"EXECUTE {name} ({args})" if params else f"EXECUTE {name}"
+
+
+CATALOG = {}
+
+
+def statement(name, sql, params=()):
+    CATALOG[name] = Statement(name, sql, list(params))
+    return CATALOG[name]
+
+
+def _prepared(conn):
+    # Names PREPAREd on this session, and names whose PREPARE may or may not
+    # have happened because the statement it was sent with failed
+    state = getattr(conn, "prepared_statements", None)
+    if state is None:
+        state = conn.prepared_statements = {"done": set(), "uncertain": set()}
+    return state
+
+
+def _run(cur, name, sql, params):
+    # Lets the SQL timing in app/metrics.py label the statement by its name
+    cur.statement_name = name
+    try:
+        cur.execute(sql, params)
+    finally:
+        cur.statement_name = None
+
+
+def execute(cur, name, params=None, prefix=""):
+    """Run catalog statement ``name``; ``prefix`` is sent first in the same round trip."""
+    stmt = CATALOG[name]
+    params = params or {}
+    if not PREPARED_STATEMENTS:
+        statement_stats["inline"] += 1
+        _run(cur, name, prefix + stmt.sql, params)
+        return
+
+    state = _prepared(cur.connection)
+    if name in state["uncertain"]:
+        cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (name,))
+        if cur.fetchone():
+            state["done"].add(name)
+        state["uncertain"].discard(name)
+
+    sql = prefix + stmt.execute_sql
+    fresh = name not in state["done"]
+    if fresh:
+        sql = stmt.prepare_sql + ";\n" + sql
+    try:
+        _run(cur, name, sql, params)
+    except Exception:
+        if fresh:
+            state["uncertain"].add(name)
+        raise
+    if fresh:
+        state["done"].add(name)
+        statement_stats["prepares"] += 1
+    statement_stats["executions"] += 1
+
+
+def fetch_dicts(cur):
+    columns = [c.name for c in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+
+# ---------------- QUEUE TRANSITIONS ----------------
+# call-next and move-next each run as a single round trip. The advisory lock
+# serialises transitions per department (two doctor consoles on one queue can
+# no longer both pick the same patient); the statement after it gets a fresh
+# snapshot, so it always sees the previous transition's result.
+QUEUE_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('queue:' || %(department_id)s));"
+
+CURRENT_TOKEN_CTE = """
+    cur AS (
+        SELECT ct.token_uuid, pt.status
+        FROM current_token ct
+        JOIN patient_tokens pt ON pt.token = ct.token_uuid
+        WHERE ct.department_id = %(department_id)s
+        ORDER BY ct.updated_at DESC
+        LIMIT 1
+    )"""
+
+# Next eligible token (recall, then waiting, then hold; oldest status change
+# first), promoted to consulting if it was waiting and recorded as the
+# department's current token. When the in-memory queue engine proposes a
+# candidate it is taken by primary key if the row still matches and no queued
+# row ranks ahead of it (a registration or status change the engine did not
+# see); otherwise (or without a candidate) the priority scan picks the token.
+STATUS_RANK_SQL = "CASE {0}.status WHEN 'recall' THEN 0 WHEN 'waiting' THEN 1 ELSE 2 END"
+
+# No queued row ranks ahead of the candidate: one probe per higher-ranked
+# status and one for older rows in its own status, each an index lookup on
+# (department_id, status, status_updated_at) that stops at the first match.
+# Written as LIMIT 1 subqueries rather than NOT EXISTS, which the planner
+# would turn into an anti-join reading every queued row.
+AHEAD_PROBE_SQL = """
+          AND (SELECT true FROM patient_tokens ahead
+               WHERE ahead.department_id = %(department_id)s
+                 AND ahead.datetime >= CURRENT_DATE AND ahead.datetime < CURRENT_DATE + 1
+                 AND {0}
+                 AND ahead.token NOT IN (SELECT token_uuid FROM cur)
+               ORDER BY ahead.status_updated_at
+               LIMIT 1) IS NULL"""
+
+AHEAD_OF_CANDIDATE_SQL = "".join(AHEAD_PROBE_SQL.format(condition) for condition in (
+    "ahead.status = 'recall' AND %(candidate_status)s IN ('waiting', 'hold')",
+    "ahead.status = 'waiting' AND %(candidate_status)s = 'hold'",
+    "ahead.status = %(candidate_status)s AND ahead.status_updated_at < pt.status_updated_at",
+))
+
+NEXT_TOKEN_CTE = """
+    candidate AS (
+        SELECT pt.token, pt.id, pt.patient_id, pt.status, pt.status_updated_at
+        FROM patient_tokens pt
+        WHERE pt.token = %(candidate)s::uuid
+          AND pt.department_id = %(department_id)s
+          AND pt.status = %(candidate_status)s
+          AND pt.datetime >= CURRENT_DATE AND pt.datetime < CURRENT_DATE + 1
+          AND pt.token NOT IN (SELECT token_uuid FROM cur)""" + AHEAD_OF_CANDIDATE_SQL + """
+        FOR UPDATE SKIP LOCKED
+    ),
+    scanned AS (
+        SELECT pt.token, pt.id, pt.patient_id, pt.status, pt.status_updated_at
+        FROM patient_tokens pt
+        WHERE NOT EXISTS (SELECT 1 FROM candidate)
+          AND pt.department_id = %(department_id)s
+          AND pt.datetime >= CURRENT_DATE AND pt.datetime < CURRENT_DATE + 1
+          AND pt.status IN ('recall', 'waiting', 'hold')
+          AND pt.token NOT IN (SELECT token_uuid FROM cur)
+        ORDER BY """ + STATUS_RANK_SQL.format("pt") + """, pt.status_updated_at ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ),
+    nxt AS (
+        SELECT * FROM candidate
+        UNION ALL
+        SELECT * FROM scanned
+    ),
+    promoted AS (
+        UPDATE patient_tokens pt
+        SET status = 'consulting', status_updated_at = NOW()
+        FROM nxt
+        WHERE pt.token = nxt.token AND nxt.status = 'waiting'
+        RETURNING pt.token
+    ),
+    assigned AS (
+        INSERT INTO current_token (token_uuid, token_number, patient_id, department_id, updated_at)
+        SELECT nxt.token, nxt.id, nxt.patient_id, %(department_id)s, NOW() FROM nxt
+        ON CONFLICT (department_id) DO UPDATE SET
+            token_uuid = EXCLUDED.token_uuid,
+            token_number = EXCLUDED.token_number,
+            patient_id = EXCLUDED.patient_id,
+            updated_at = NOW()
+        RETURNING token_uuid
+    )"""
+
+NEXT_TOKEN_SELECT = """
+    SELECT 'next' AS role, nxt.id, nxt.token, nxt.patient_id,
+           CASE WHEN nxt.status = 'waiting' THEN 'consulting' ELSE nxt.status END AS status,
+           nxt.status_updated_at, p.first_name, p.last_name
+    FROM nxt
+    JOIN patients p ON p.patient_id = nxt.patient_id"""
+
+CALL_NEXT_SQL = """
+    WITH""" + CURRENT_TOKEN_CTE + """,
+    completed AS (
+        UPDATE patient_tokens pt
+        SET status = 'completed', status_updated_at = NOW()
+        FROM cur
+        WHERE pt.token = cur.token_uuid
+        RETURNING pt.id, pt.token, pt.patient_id, pt.status, pt.status_updated_at
+    ),""" + NEXT_TOKEN_CTE + """
+    SELECT 'current' AS role, c.id, c.token, c.patient_id, c.status, c.status_updated_at,
+           p.first_name, p.last_name
+    FROM completed c
+    JOIN patients p ON p.patient_id = c.patient_id
+    UNION ALL""" + NEXT_TOKEN_SELECT
+
+MOVE_NEXT_SQL = """
+    WITH""" + CURRENT_TOKEN_CTE + """,
+    moved AS (
+        UPDATE patient_tokens pt
+        SET status = CASE cur.status
+                         WHEN 'consulting' THEN 'recall'
+                         WHEN 'recall' THEN 'hold'
+                         WHEN 'hold' THEN 'no_show'
+                         ELSE 'recall'
+                     END,
+            status_updated_at = NOW()
+        FROM cur
+        WHERE pt.token = cur.token_uuid
+        RETURNING pt.id, pt.token, pt.patient_id, pt.status, pt.status_updated_at
+    ),""" + NEXT_TOKEN_CTE + """
+    SELECT 'current' AS role, m.id, m.token, m.patient_id, m.status, m.status_updated_at,
+           p.first_name, p.last_name
+    FROM moved m
+    JOIN patients p ON p.patient_id = m.patient_id
+    UNION ALL""" + NEXT_TOKEN_SELECT
+
+
+statement("call_next", CALL_NEXT_SQL, [
+    ("department_id", "varchar"), ("candidate", "uuid"), ("candidate_status", "varchar")])
+statement("move_next", MOVE_NEXT_SQL, [
+    ("department_id", "varchar"), ("candidate", "uuid"), ("candidate_status", "varchar")])
+
+# One set-based status change for today's tokens of a department in the given
+# statuses (optionally only the listed tokens). is_current marks the token
+# on the department's display.
+statement("bulk_transition", """
+    WITH updated AS (
+        UPDATE patient_tokens pt
+        SET status = %(to_status)s, status_updated_at = NOW()
+        WHERE pt.department_id = %(department_id)s
+          AND pt.datetime >= CURRENT_DATE AND pt.datetime < CURRENT_DATE + 1
+          AND pt.status = ANY(%(from_statuses)s)
+          AND pt.status <> %(to_status)s
+          AND (%(tokens)s::uuid[] IS NULL OR pt.token = ANY(%(tokens)s::uuid[]))
+        RETURNING pt.token, pt.id, pt.patient_id, pt.status, pt.status_updated_at
+    )
+    SELECT u.token, u.id, u.status, u.status_updated_at, ct.token_uuid IS NOT NULL AS is_current,
+           p.first_name, p.last_name
+    FROM updated u
+    LEFT JOIN current_token ct ON ct.department_id = %(department_id)s AND ct.token_uuid = u.token
+    LEFT JOIN patients p ON p.patient_id = u.patient_id
+    ORDER BY u.id
+""", [("to_status", "varchar"), ("department_id", "varchar"), ("from_statuses", "varchar[]"),
+      ("tokens", "text[]")])
+
+# Expired tokens nobody called, at most batch_size per statement; rows another
+# transaction holds are left for the next batch. is_current marks a token still
+# on its department's display.
+statement("sweep_expired", """
+    WITH batch AS (
+        SELECT token, datetime FROM patient_tokens
+        WHERE expires_at < NOW() AND status IN ('waiting', 'recall', 'hold')
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    updated AS (
+        UPDATE patient_tokens pt
+        SET status = 'no_show', status_updated_at = NOW()
+        FROM batch
+        WHERE pt.token = batch.token AND pt.datetime = batch.datetime
+        RETURNING pt.department_id, pt.token, pt.id, pt.patient_id, pt.status_updated_at
+    )
+    SELECT u.department_id, u.token, u.id, u.status_updated_at, ct.token_uuid IS NOT NULL AS is_current,
+           p.first_name, p.last_name
+    FROM updated u
+    LEFT JOIN current_token ct ON ct.department_id = u.department_id AND ct.token_uuid = u.token
+    LEFT JOIN patients p ON p.patient_id = u.patient_id
+""", [("batch_size", "integer")])
+
+
+# ---------------- CURRENT TOKENS ----------------
+CURRENT_TOKENS_SQL = """
+    SELECT ct.department_id, ct.token_number, ct.patient_id, pt.status,
+           p.first_name, p.last_name
+    FROM current_token ct
+    LEFT JOIN patient_tokens pt ON pt.token = ct.token_uuid
+    LEFT JOIN patients p ON p.patient_id = ct.patient_id
+"""
+
+statement("current_tokens", CURRENT_TOKENS_SQL + " ORDER BY ct.department_id")
+statement("current_tokens_for", CURRENT_TOKENS_SQL + """
+    WHERE ct.department_id = ANY(%(department_ids)s)
+    ORDER BY ct.department_id
+""", [("department_ids", "varchar[]")])
+
+statement("announce_current", """
+    SELECT ct.token_number, p.first_name, p.last_name, pt.status
+    FROM current_token ct
+    JOIN patients p ON ct.patient_id = p.patient_id
+    LEFT JOIN patient_tokens pt ON pt.token = ct.token_uuid
+    WHERE ct.department_id = %(department_id)s
+    ORDER BY ct.updated_at DESC
+    LIMIT 1
+""", [("department_id", "varchar")])
+
+
+# ---------------- REGISTRATION ----------------
+statement("bump_token_counter", """
+    UPDATE token_counters SET last_value = last_value + %(count)s
+    WHERE department_id = %(department_id)s AND day = %(day)s
+    RETURNING last_value
+""", [("count", "integer"), ("department_id", "varchar"), ("day", "date")])
+
+# First registration of the day: seed the counter from any tokens already
+# issued (e.g. before the counter table existed)
+statement("seed_token_counter", """
+    INSERT INTO token_counters (department_id, day, last_value)
+    SELECT %(department_id)s, %(day)s, COALESCE(MAX(id), 0) + %(count)s
+    FROM patient_tokens
+    WHERE department_id = %(department_id)s AND datetime >= %(day_start)s AND datetime < %(day_end)s
+    ON CONFLICT (department_id, day) DO UPDATE
+        SET last_value = token_counters.last_value + %(count)s
+    RETURNING last_value
+""", [("department_id", "varchar"), ("day", "date"), ("count", "integer"),
+      ("day_start", "timestamp"), ("day_end", "timestamp")])
+
+statement("insert_token", """
+    INSERT INTO patient_tokens
+    (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
+    VALUES (%(token)s, %(id)s, %(patient_id)s, %(department_id)s, %(datetime)s, %(expires_at)s,
+            'waiting', %(now)s)
+""", [("token", "uuid"), ("id", "integer"), ("patient_id", "varchar"), ("department_id", "varchar"),
+      ("datetime", "timestamp"), ("expires_at", "timestamp"), ("now", "timestamp")])
+
+statement("card_details", """
+    SELECT pt.id, pt.patient_id, pt.department_id, pt.expires_at, p.first_name, p.last_name
+    FROM patient_tokens pt
+    LEFT JOIN patients p ON p.patient_id = pt.patient_id
+    WHERE pt.token = %(token)s
+""", [("token", "uuid")])
+
+
+# ---------------- QUEUE LISTING ----------------
+QUEUE_PARAMS = [("department_id", "varchar"), ("day_start", "timestamp"), ("day_end", "timestamp")]
+
+QUEUE_SELECT = """
+    SELECT id, token, patient_id,
+           to_char(datetime, 'YYYY-MM-DD HH24:MI'),
+           status,
+           to_char(status_updated_at, 'YYYY-MM-DD HH24:MI:SS'),
+           to_char(status_updated_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+    FROM patient_tokens
+    WHERE department_id = %(department_id)s AND datetime >= %(day_start)s AND datetime < %(day_end)s
+"""
+
+statement("queue_signature", """
+    SELECT count(*), COALESCE(sum(hashtext(token::text || status || status_updated_at::text)::bigint), 0)
+    FROM patient_tokens
+    WHERE department_id = %(department_id)s AND datetime >= %(day_start)s AND datetime < %(day_end)s
+""", QUEUE_PARAMS)
+
+statement("queue_rows", QUEUE_SELECT + " ORDER BY id ASC", QUEUE_PARAMS)
+
+statement("queue_changes", QUEUE_SELECT + """
+      AND (status_updated_at, token) > (%(since_at)s, %(since_token)s)
+    ORDER BY status_updated_at ASC, token ASC
+    LIMIT %(limit)s
+""", QUEUE_PARAMS + [("since_at", "timestamp"), ("since_token", "uuid"), ("limit", "integer")])
+
+
+# ---------------- QUEUE STATISTICS ----------------
+# Today's row per department (all departments when department_ids is NULL),
+# with the last earlier day's consult average to fall back on before the
+# first consult of the day
+statement("queue_stats", """
+    SELECT s.department_id, s.waiting, s.consulting, s.recall, s.hold, s.no_show, s.completed,
+           s.consult_count, s.consult_avg_seconds,
+           (SELECT p.consult_avg_seconds FROM queue_stats p
+            WHERE p.department_id = s.department_id AND p.day < s.day AND p.consult_avg_seconds IS NOT NULL
+            ORDER BY p.day DESC LIMIT 1) AS previous_avg_seconds,
+           s.updated_at
+    FROM queue_stats s
+    WHERE s.day = CURRENT_DATE
+      AND (%(department_ids)s::varchar[] IS NULL OR s.department_id = ANY(%(department_ids)s::varchar[]))
+    ORDER BY s.department_id
+""", [("department_ids", "varchar[]")])
+
+
+# ---------------- IDEMPOTENCY KEYS ----------------
+IDEMPOTENCY_KEY_PARAMS = [("endpoint", "varchar"), ("key", "varchar")]
+
+# Claims the key and returns claimed = true, or returns the row already holding
+# it. A stored response is kept for the window; an unfinished claim only for the
+# lease, after which a retry takes it over (its request died or lost its worker).
+statement("idempotency_claim", """
+    WITH claimed AS (
+        INSERT INTO idempotency_keys (endpoint, key, request_hash, claim_id, claimed_at)
+        VALUES (%(endpoint)s, %(key)s, %(request_hash)s, %(claim_id)s, NOW())
+        ON CONFLICT (endpoint, key) DO UPDATE SET
+            request_hash = EXCLUDED.request_hash, status_code = NULL, response = NULL,
+            claim_id = EXCLUDED.claim_id, claimed_at = NOW(), created_at = NOW()
+        WHERE idempotency_keys.created_at < NOW() - make_interval(secs => %(window)s)
+           OR (idempotency_keys.status_code IS NULL
+               AND idempotency_keys.claimed_at < NOW() - make_interval(secs => %(lease)s))
+        RETURNING 1
+    )
+    SELECT true, NULL, NULL, NULL FROM claimed
+    UNION ALL
+    SELECT false, request_hash, status_code, response FROM idempotency_keys
+    WHERE endpoint = %(endpoint)s AND key = %(key)s AND NOT EXISTS (SELECT 1 FROM claimed)
+""", IDEMPOTENCY_KEY_PARAMS + [("request_hash", "char(64)"), ("claim_id", "uuid"), ("window", "integer"),
+                               ("lease", "integer")])
+
+# Both only touch the key while this request still holds the claim
+statement("idempotency_store", """
+    UPDATE idempotency_keys SET status_code = %(status_code)s, response = %(response)s
+    WHERE endpoint = %(endpoint)s AND key = %(key)s AND claim_id = %(claim_id)s
+""", IDEMPOTENCY_KEY_PARAMS + [("claim_id", "uuid"), ("status_code", "integer"), ("response", "text")])
+
+statement("idempotency_release", """
+    DELETE FROM idempotency_keys
+    WHERE endpoint = %(endpoint)s AND key = %(key)s AND claim_id = %(claim_id)s AND status_code IS NULL
+""", IDEMPOTENCY_KEY_PARAMS + [("claim_id", "uuid")])
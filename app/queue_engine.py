@@ -0,0 +1,243 @@
+import heapq
+import itertools
+import threading
+from datetime import date, datetime, timedelta
+
+from app.db import get_db_connection
+from app_config import QUEUE_ENGINE, EVENT_BUS
+
+# Lower is served first; tokens in any other status are not queued
+STATUS_PRIORITY = {"recall": 0, "waiting": 1, "hold": 2}
+
+
+def _day_bounds(day):
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+# ---------------- PER-DEPARTMENT QUEUE ----------------
+class DepartmentQueue:
+    """Heap of (priority, status_updated_at, version, token) with lazy deletion.
+
+    ``tokens`` holds the live state of every queued token; a heap entry whose
+    version no longer matches is stale and skipped when it reaches the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.tokens = {}      # token -> (status, status_updated_at, version)
+        self.current = None   # token on the department's display, never proposed
+        self._versions = itertools.count()
+
+    def set(self, token, status, updated_at):
+        if status in STATUS_PRIORITY:
+            version = next(self._versions)
+            self.tokens[token] = (status, updated_at, version)
+            heapq.heappush(self.heap, (STATUS_PRIORITY[status], updated_at, version, token))
+        else:
+            self.tokens.pop(token, None)
+
+    def peek(self):
+        skipped = []
+        found = None
+        while self.heap:
+            _, _, version, token = self.heap[0]
+            entry = self.tokens.get(token)
+            if entry is None or entry[2] != version:
+                heapq.heappop(self.heap)
+                continue
+            if token == self.current:
+                skipped.append(heapq.heappop(self.heap))
+                continue
+            found = {"token": token, "status": entry[0]}
+            break
+        for item in skipped:
+            heapq.heappush(self.heap, item)
+        return found
+
+
+# ---------------- ENGINE ----------------
+class QueueEngine:
+    """In-process next-patient selection, written through to Postgres.
+
+    Each department's queue is loaded from patient_tokens on first use (or by
+    ``warm()``) and then kept current from registrations and the rows returned
+    by call-next/move-next. The database stays authoritative: the transition
+    statement only takes the proposed token if its row still matches and no
+    queued row ranks ahead of it, and a department whose proposal is rejected
+    is reloaded.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._day = date.today()
+        self._stats = {"proposals": 0, "accepted": 0, "stale": 0, "resyncs": 0}
+
+    # ---- loading ----
+    def _fetch(self, department_id=None):
+        """Read queued tokens and current tokens for today from the database."""
+        day_start, day_end = _day_bounds(date.today())
+        queued_sql = """
+            SELECT department_id, token, status, status_updated_at
+            FROM patient_tokens
+            WHERE datetime >= %s AND datetime < %s
+              AND status IN ('recall', 'waiting', 'hold')
+        """
+        current_sql = "SELECT department_id, token_uuid FROM current_token"
+        queued_params = [day_start, day_end]
+        current_params = []
+        if department_id is not None:
+            queued_sql += " AND department_id = %s"
+            queued_params.append(str(department_id))
+            current_sql += " WHERE department_id = %s"
+            current_params.append(str(department_id))
+
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(queued_sql, queued_params)
+                queued = cur.fetchall()
+                cur.execute(current_sql, current_params)
+                current = dict((str(d), str(t)) for d, t in cur.fetchall())
+        return queued, current
+
+    def _build(self, queued, current, department_ids):
+        queues = {str(d): DepartmentQueue() for d in department_ids}
+        for department_id, token, status, updated_at in queued:
+            queues.setdefault(str(department_id), DepartmentQueue()).set(str(token), status, updated_at)
+        for department_id, queue in queues.items():
+            queue.current = current.get(department_id)
+        return queues
+
+    def _check_day(self):
+        if date.today() != self._day:
+            self._queues = {}
+            self._day = date.today()
+
+    def warm(self):
+        if not self.enabled:
+            return
+        queued, current = self._fetch()
+        queues = self._build(queued, current, current.keys())
+        with self._lock:
+            self._day = date.today()
+            self._queues = queues
+
+    def resync(self, department_id):
+        key = str(department_id)
+        queued, current = self._fetch(key)
+        queue = self._build(queued, current, [key])[key]
+        with self._lock:
+            self._check_day()
+            self._queues[key] = queue
+            self._stats["resyncs"] += 1
+        return queue
+
+    def _queue(self, department_id):
+        with self._lock:
+            self._check_day()
+            queue = self._queues.get(str(department_id))
+        return queue if queue is not None else self.resync(department_id)
+
+    # ---- hot path ----
+    def next_candidate(self, department_id):
+        if not self.enabled:
+            return None
+        queue = self._queue(department_id)
+        with self._lock:
+            candidate = queue.peek()
+            if candidate:
+                self._stats["proposals"] += 1
+        return candidate
+
+    def apply_transition(self, department_id, candidate, current, next_token):
+        """Fold a committed call-next/move-next result into the queue."""
+        if not self.enabled:
+            return
+        chosen = str(next_token["uuid"]) if next_token else None
+        if candidate and chosen == candidate["token"]:
+            self._stats["accepted"] += 1
+        elif candidate or chosen:
+            # The database disagreed with the proposal (or found a token the
+            # engine did not know about): reload this department.
+            self._stats["stale"] += 1
+            self.resync(department_id)
+            return
+
+        queue = self._queue(department_id)
+        with self._lock:
+            if current:
+                queue.set(str(current["uuid"]), current["status"], current["status_updated_at"])
+            if next_token:
+                queue.set(chosen, next_token["status"], next_token["status_updated_at"])
+                queue.current = chosen
+
+    def apply_statuses(self, department_id, changes):
+        """Fold committed bulk status changes ``[(token, status, status_updated_at)]`` into the queue."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._check_day()
+            queue = self._queues.get(str(department_id))
+            if queue is not None:
+                for token, status, status_updated_at in changes:
+                    queue.set(str(token), status, status_updated_at)
+
+    def add_token(self, department_id, token, status, status_updated_at, token_datetime):
+        if not self.enabled or token_datetime.date() != date.today():
+            return
+        with self._lock:
+            self._check_day()
+            queue = self._queues.get(str(department_id))
+            # Departments not loaded yet pick the token up when they are
+            if queue is not None:
+                queue.set(str(token), status, status_updated_at)
+
+    # ---- consistency ----
+    def diff(self, department_id=None):
+        """Compare the in-memory queues with patient_tokens.
+
+        Returns ``{department_id: {"missing", "extra", "mismatched"}}`` for
+        every department that differs; an empty dict means consistent.
+        """
+        queued, current = self._fetch(department_id)
+        expected = self._build(queued, current, current.keys())
+        with self._lock:
+            self._check_day()
+            if department_id is not None:
+                loaded = {str(department_id): self._queues.get(str(department_id))}
+            else:
+                loaded = dict(self._queues)
+            snapshot = {
+                key: {t: (s, ts) for t, (s, ts, _) in q.tokens.items()} if q is not None else None
+                for key, q in loaded.items()
+            }
+
+        report = {}
+        for key, actual in snapshot.items():
+            if actual is None:
+                continue   # not loaded yet; loads fresh on first use
+            db_queue = expected.get(key, DepartmentQueue())
+            wanted = {t: (s, ts) for t, (s, ts, _) in db_queue.tokens.items()}
+            missing = sorted(set(wanted) - set(actual))
+            extra = sorted(set(actual) - set(wanted))
+            mismatched = sorted(t for t in set(wanted) & set(actual) if wanted[t] != actual[t])
+            if missing or extra or mismatched:
+                report[key] = {"missing": missing, "extra": extra, "mismatched": mismatched}
+        return report
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["enabled"] = self.enabled
+            stats["departments"] = {
+                key: {"queued": len(queue.tokens), "heap_entries": len(queue.heap), "current": queue.current}
+                for key, queue in self._queues.items()
+            }
+        return stats
+
+
+# The engine only sees this process's transitions, so it is disabled when
+# several workers share the queue through the Postgres event bus.
+queue_engine = QueueEngine(enabled=QUEUE_ENGINE == "memory" and EVENT_BUS != "postgres")
@@ -0,0 +1,141 @@
+"""Per-department queue statistics: tokens per status and an estimated wait.
+
+    python -m app.queue_stats status     # today's statistics per department
+    python -m app.queue_stats rebuild    # recount today's tokens (after manual edits)
+
+queue_stats (migrations 8 and 11) is kept current by a trigger on
+patient_tokens: every registration, status change and deletion adjusts its
+department's counters in the same transaction, and a consulting -> completed
+change feeds the moving average of consult durations. Reading the statistics is a primary-key lookup
+however long the queue is. They are served at GET /api/queue-stats and
+pushed to the department's displays as ``queue-stats`` after each change.
+
+The estimated wait of a patient registering now is the tokens ahead of them
+(recall and waiting) times the average consult; before the day's first
+consult the department's last average is used.
+"""
+import logging
+import sys
+
+from app import queries
+from app.db import get_db_connection
+
+log = logging.getLogger(__name__)
+
+STATUSES = ("waiting", "consulting", "recall", "hold", "no_show", "completed")
+
+# Departments whose tokens are all gone keep a row, with zero counts
+RESET_SQL = """
+    UPDATE queue_stats
+    SET waiting = 0, consulting = 0, recall = 0, hold = 0, no_show = 0, completed = 0, updated_at = NOW()
+    WHERE day = CURRENT_DATE
+"""
+
+REBUILD_SQL = """
+    INSERT INTO queue_stats (department_id, day, waiting, consulting, recall, hold, no_show, completed)
+    SELECT department_id, datetime::date,
+           count(*) FILTER (WHERE status = 'waiting'),
+           count(*) FILTER (WHERE status = 'consulting'),
+           count(*) FILTER (WHERE status = 'recall'),
+           count(*) FILTER (WHERE status = 'hold'),
+           count(*) FILTER (WHERE status = 'no_show'),
+           count(*) FILTER (WHERE status = 'completed')
+    FROM patient_tokens
+    WHERE datetime >= CURRENT_DATE AND datetime < CURRENT_DATE + 1
+    GROUP BY department_id, datetime::date
+    ON CONFLICT (department_id, day) DO UPDATE SET
+        waiting = EXCLUDED.waiting, consulting = EXCLUDED.consulting, recall = EXCLUDED.recall,
+        hold = EXCLUDED.hold, no_show = EXCLUDED.no_show, completed = EXCLUDED.completed,
+        updated_at = NOW()
+"""
+
+
+def _department_stats(row):
+    (department_id, waiting, consulting, recall, hold, no_show, completed,
+     consult_count, consult_avg, previous_avg, updated_at) = row
+    average = consult_avg if consult_avg is not None else previous_avg
+    ahead = recall + waiting
+    return department_id, {
+        "department_id": department_id,
+        "counts": dict(zip(STATUSES, (waiting, consulting, recall, hold, no_show, completed))),
+        "queued": recall + waiting + hold,
+        "consults": consult_count,
+        "avg_consult_seconds": round(average, 1) if average is not None else None,
+        "estimated_wait_seconds": round(ahead * average) if average is not None else None,
+        "updated_at": updated_at.isoformat(),
+    }
+
+
+def fetch_queue_stats(department_ids=None):
+    """``{department_id: stats}`` for today; departments without tokens today are absent."""
+    params = {"department_ids": [str(d) for d in department_ids] if department_ids is not None else None}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            queries.execute(cur, "queue_stats", params)
+            rows = cur.fetchall()
+    return dict(_department_stats(row) for row in rows)
+
+
+def empty_stats(department_id):
+    return {
+        "department_id": str(department_id),
+        "counts": dict.fromkeys(STATUSES, 0),
+        "queued": 0,
+        "consults": 0,
+        "avg_consult_seconds": None,
+        "estimated_wait_seconds": None,
+        "updated_at": None,
+    }
+
+
+# ---------------- PUSH ----------------
+def push_queue_stats(department_id):
+    from app.realtime import safe_emit
+
+    try:
+        stats = fetch_queue_stats([department_id]).get(str(department_id)) or empty_stats(department_id)
+    except Exception as e:
+        log.warning("Queue stats push failed: %s", e,
+                    extra={"department_id": department_id, "sample": "queue_stats_push_failed"})
+        return
+    safe_emit("queue-stats", stats, department_id)
+
+
+def schedule_push(department_id):
+    """Push the department's statistics after the response has gone out."""
+    from app import socketio
+
+    socketio.start_background_task(push_queue_stats, str(department_id))
+
+
+def rebuild():
+    """Recount today's tokens; returns the number of departments rewritten."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Holds off registrations and transitions so none is counted twice
+            cur.execute("LOCK TABLE patient_tokens IN SHARE MODE")
+            cur.execute(RESET_SQL)
+            cur.execute(REBUILD_SQL)
+            return cur.rowcount
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "status"
+    if command == "status":
+        for department_id, stats in fetch_queue_stats().items():
+            counts = "  ".join(f"{status} {n}" for status, n in stats["counts"].items())
+            average, wait = stats["avg_consult_seconds"], stats["estimated_wait_seconds"]
+            print(f"{department_id:<8} {counts}  avg consult {'-' if average is None else f'{average}s'}  "
+                  f"wait {'-' if wait is None else f'{wait}s'}")
+    elif command == "rebuild":
+        print(f"Rebuilt {rebuild()} departments")
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    from app.log import configure_logging
+    configure_logging()
+    sys.exit(main(sys.argv))
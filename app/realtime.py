@@ -0,0 +1,200 @@
+import logging
+import threading
+
+from flask import request
+from flask_socketio import emit, join_room, leave_room
+from app import socketio
+from app.event_bus import bus_enabled, publish, bus_stats
+from app.department_cache import department_cache
+from app.display_state import display_state, EPOCH
+from app_config import EMIT_COALESCE_MS
+
+log = logging.getLogger(__name__)
+
+# Every display joins one room per department it shows; token updates are
+# emitted to that room only instead of being broadcast to every screen.
+emit_stats = {
+    "emits": 0,
+    "failures": 0,
+    "deliveries": 0,             # clients actually reached
+    "broadcast_deliveries": 0,   # clients a global broadcast would have reached
+    "coalesced": 0,              # updates superseded within the coalescing window
+    "per_department": {},
+}
+
+
+def department_room(department_id):
+    return f"department:{department_id}"
+
+
+def _participant_count(room, namespace="/"):
+    try:
+        return sum(1 for _ in socketio.server.manager.get_participants(namespace, room))
+    except Exception:
+        return 0
+
+
+def _parse_department_ids(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value if str(v).strip()]
+    return [v.strip() for v in str(value).split(",") if v.strip()]
+
+
+# ---------------- EMIT COALESCING ----------------
+class EmitCoalescer:
+    """Collapse bursts of updates for one department into the latest state.
+
+    The first update after a quiet period goes out immediately. Updates that
+    follow within ``window`` seconds only replace a pending one, which is sent
+    when the window closes; so a burst costs at most one extra emit (and one
+    re-render and announcement on every display) per window.
+    """
+
+    def __init__(self, window, send):
+        self.window = window
+        self.send = send
+        self._lock = threading.Lock()
+        self._open = set()      # (event, department_id) inside a window
+        self._pending = {}      # (event, department_id) -> latest data
+
+    def submit(self, event, data, department_id):
+        key = (event, str(department_id))
+        with self._lock:
+            if key in self._open:
+                previous = self._pending.get(key)
+                if previous is not None:
+                    emit_stats["coalesced"] += 1
+                    # Keep a re-announcement of the same token
+                    if previous.get("force") and previous.get("token") == data.get("token"):
+                        data = dict(data, force=True)
+                self._pending[key] = data
+                return
+            self._open.add(key)
+        self.send(event, data, department_id)
+        socketio.start_background_task(self._drain, key, department_id)
+
+    def _drain(self, key, department_id):
+        while True:
+            socketio.sleep(self.window)
+            with self._lock:
+                data = self._pending.pop(key, None)
+                if data is None:
+                    self._open.discard(key)
+                    return
+            self.send(key[0], data, department_id)
+
+
+# Events that carry a department's latest state, so only the newest matters
+COALESCED_EVENTS = ("update-token", "queue-stats")
+
+
+def safe_emit(event, data, department_id=None):
+    """Emit to a department's room on every worker.
+
+    With the Postgres event bus enabled the event is published through NOTIFY
+    and each worker (this one included) re-emits it to its own clients.
+    Token updates and queue statistics are coalesced per department first
+    (EMIT_COALESCE_MS).
+    """
+    if event in COALESCED_EVENTS and department_id is not None and _coalescer is not None:
+        _coalescer.submit(event, data, department_id)
+    else:
+        _dispatch(event, data, department_id)
+
+
+def _dispatch(event, data, department_id=None):
+    if bus_enabled():
+        try:
+            if publish(event, data, department_id):
+                return
+        except Exception as e:
+            log.warning("Event bus publish failed, emitting locally: %s", e,
+                        extra={"event": event, "department_id": department_id, "sample": "bus_publish_failed"})
+    emit_local(event, data, department_id)
+
+
+_coalescer = EmitCoalescer(EMIT_COALESCE_MS / 1000, _dispatch) if EMIT_COALESCE_MS > 0 else None
+
+
+def emit_local(event, data, department_id=None):
+    room = department_room(department_id) if department_id is not None else None
+    if event == "update-token" and department_id is not None:
+        # Displays compare seq with the last one they saw to detect a gap
+        data = dict(data, seq=display_state.apply(department_id, data), epoch=EPOCH)
+    try:
+        socketio.emit(event, data, to=room)
+    except Exception as e:
+        emit_stats["failures"] += 1
+        log.warning("SocketIO emit failed: %s", e,
+                    extra={"event": event, "department_id": department_id, "sample": "emit_failed"})
+        return
+
+    delivered = _participant_count(room)
+    emit_stats["emits"] += 1
+    emit_stats["deliveries"] += delivered
+    emit_stats["broadcast_deliveries"] += _participant_count(None)
+    if department_id is not None:
+        dept = emit_stats["per_department"].setdefault(str(department_id), {"emits": 0, "deliveries": 0})
+        dept["emits"] += 1
+        dept["deliveries"] += delivered
+
+
+def get_emit_stats():
+    stats = dict(emit_stats)
+    stats["per_department"] = {k: dict(v) for k, v in emit_stats["per_department"].items()}
+    stats["connected_clients"] = _participant_count(None)
+    stats["event_bus"] = dict(bus_stats, enabled=bus_enabled())
+    stats["display_state"] = display_state.stats()
+    stats["rooms"] = {
+        room: _participant_count(room)
+        for room in socketio.server.manager.rooms.get("/", {})
+        if isinstance(room, str) and room.startswith("department:")
+    } if socketio.server else {}
+    return stats
+
+
+# ---------------- SOCKET.IO SUBSCRIPTIONS ----------------
+# Joining a department's room is followed by a 'snapshot' of what its
+# displays should show, so screens need no REST calls to bootstrap and
+# cannot miss an update between loading state and joining the room.
+def _send_snapshot(department_ids):
+    if department_ids:
+        emit('snapshot', display_state.snapshot(department_ids))
+
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    # Single-department screens pass ?department_id=X in the connection URL
+    department_ids = _parse_department_ids(request.args.get("department_id"))
+    for department_id in department_ids:
+        join_room(department_room(department_id))
+    _send_snapshot(department_ids)
+
+
+@socketio.on('subscribe')
+def on_subscribe(data):
+    data = data or {}
+    if data.get("all"):
+        department_ids = [str(d["id"]) for d in department_cache.all()]
+    else:
+        department_ids = _parse_department_ids(data.get("department_ids"))
+    for department_id in department_ids:
+        join_room(department_room(department_id))
+    _send_snapshot(department_ids)
+    return {"subscribed": department_ids}
+
+
+@socketio.on('resync')
+def on_resync(data):
+    # Sent by a display that saw a gap in seq or a new epoch
+    _send_snapshot(_parse_department_ids((data or {}).get("department_ids")))
+
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(data):
+    department_ids = _parse_department_ids((data or {}).get("department_ids"))
+    for department_id in department_ids:
+        leave_room(department_room(department_id))
+    return {"unsubscribed": department_ids}
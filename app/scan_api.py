@@ -1,66 +1,166 @@
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
-from pyaadhaar.decode import AadhaarSecureQr
+from collections import OrderedDict
+import hashlib
 import json
+import logging
+import threading
+import time
 import xml.etree.ElementTree as ET
+from app.metrics import qr_decode_duration
 
 scan_bp = Blueprint('scan_bp', __name__)
 CORS(scan_bp)
+log = logging.getLogger(__name__)
 
+PARSE_CACHE_SIZE = 2048
+MAX_BATCH_SIZE = 500
+
+# ---------------- DECODERS ----------------
+def decode_secure(qr_data):
+    # pyaadhaar (and its imaging dependencies) load on the first secure QR
+    from pyaadhaar.decode import AadhaarSecureQr
+
+    secure = AadhaarSecureQr(qr_data)
+    data = secure.decodeddata()
+    address = ", ".join(filter(None, [
+        data.get("house"), data.get("street"), data.get("vtc"),
+        data.get("subdistrict"), data.get("district"),
+        data.get("state"), data.get("pincode")
+    ]))
+    return {
+        "source": "secure",
+        "name": data.get("name"),
+        "dob": data.get("dob"),
+        "gender": data.get("gender"),
+        "address": address
+    }
+
+def decode_plain_xml(qr_data):
+    xml_root = ET.fromstring(qr_data)
+    data = xml_root.attrib
+    address = ", ".join(filter(None, [
+        data.get("house"), data.get("loc"), data.get("vtc"),
+        data.get("dist"), data.get("state"), data.get("pc")
+    ]))
+    return {
+        "source": "plain",
+        "name": data.get("name"),
+        "dob": data.get("dob", data.get("yob")),
+        "gender": data.get("gender"),
+        "address": address
+    }
+
+def decode_abha(qr_data):
+    abha = json.loads(qr_data)
+    address = abha.get("address", "")
+    return {
+        "source": "abha",
+        "name": abha.get("name"),
+        "dob": abha.get("dob"),
+        "gender": abha.get("gender"),
+        "address": address
+    }
+
+DECODERS = {
+    "secure": decode_secure,
+    "plain": decode_plain_xml,
+    "abha": decode_abha,
+}
+
+def sniff_format(qr_data):
+    """Pick the decoder from the payload's first characters."""
+    if qr_data.isdigit():
+        return "secure"      # Secure QR is one big base-10 integer
+    if qr_data.startswith("<"):
+        return "plain"
+    if qr_data.startswith("{"):
+        return "abha"
+    return None
+
+# ---------------- CACHE AND TIMINGS ----------------
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"cache_hits": 0, "cache_misses": 0, "unrecognised": 0, "formats": {}}
+
+def _record_timing(fmt, elapsed, ok):
+    entry = _stats["formats"].setdefault(fmt, {"decoded": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0})
+    entry["decoded" if ok else "failed"] += 1
+    elapsed_ms = elapsed * 1000
+    entry["total_ms"] += elapsed_ms
+    entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+def parse_payload(qr_data):
+    """Decode one scan; returns ``(result, error)`` with exactly one of them set."""
+    key = hashlib.sha256(qr_data.encode("utf-8")).hexdigest()
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            _stats["cache_hits"] += 1
+            return cached
+    _stats["cache_misses"] += 1
+
+    fmt = sniff_format(qr_data)
+    if fmt is None:
+        _stats["unrecognised"] += 1
+        outcome = (None, "Unsupported or invalid QR data")
+    else:
+        started = time.perf_counter()
+        try:
+            outcome = (DECODERS[fmt](qr_data), None)
+        except Exception as e:
+            log.info("QR decode failed: %s", e, extra={"format": fmt, "sample": f"qr_decode_failed:{fmt}"})
+            outcome = (None, "Unsupported or invalid QR data")
+        elapsed = time.perf_counter() - started
+        _record_timing(fmt, elapsed, outcome[0] is not None)
+        qr_decode_duration.observe(elapsed, format=fmt, outcome="decoded" if outcome[0] is not None else "failed")
+
+    with _cache_lock:
+        _cache[key] = outcome
+        while len(_cache) > PARSE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return outcome
+
+# ---------------- PARSE API ----------------
 @scan_bp.route('/parse_qr', methods=['POST'])
 def parse_qr():
     qr_data = request.json.get('qrData', '').strip()
 
-    # 1. Secure QR
-    try:
-        secure = AadhaarSecureQr(qr_data)
-        data = secure.decodeddata()
-        address = ", ".join(filter(None, [
-            data.get("house"), data.get("street"), data.get("vtc"),
-            data.get("subdistrict"), data.get("district"),
-            data.get("state"), data.get("pincode")
-        ]))
-        return jsonify({
-            "source": "secure",
-            "name": data.get("name"),
-            "dob": data.get("dob"),
-            "gender": data.get("gender"),
-            "address": address
-        })
-    except Exception as e:
-        print("Secure QR Decode Error:", e)
-
-    # 2. Plain XML
-    try:
-        if qr_data.strip().startswith("<"):
-            xml_root = ET.fromstring(qr_data)
-            data = xml_root.attrib
-            address = ", ".join(filter(None, [
-                data.get("house"), data.get("loc"), data.get("vtc"),
-                data.get("dist"), data.get("state"), data.get("pc")
-            ]))
-            return jsonify({
-                "source": "plain",
-                "name": data.get("name"),
-                "dob": data.get("dob", data.get("yob")),
-                "gender": data.get("gender"),
-                "address": address
-            })
-    except Exception as e:
-        print("Plain XML QR Decode Error:", e)
-
-    # 3. ABHA
-    try:
-        abha = json.loads(qr_data)
-        address = abha.get("address", "")
-        return jsonify({
-            "source": "abha",
-            "name": abha.get("name"),
-            "dob": abha.get("dob"),
-            "gender": abha.get("gender"),
-            "address": address
-        })
-    except Exception as e:
-        print("ABHA QR Decode Error:", e)
-
-    return jsonify({'error': 'Unsupported or invalid QR data'}), 400
+    result, error = parse_payload(qr_data)
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify(result)
+
+@scan_bp.route('/parse_qr/batch', methods=['POST'])
+def parse_qr_batch():
+    items = (request.get_json() or {}).get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list of QR payloads'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} items per batch'}), 400
+
+    results = []
+    for index, qr_data in enumerate(items):
+        result, error = parse_payload(str(qr_data).strip())
+        results.append({'index': index, 'error': error} if error else dict(result, index=index))
+
+    return jsonify({
+        'decoded': sum(1 for r in results if 'error' not in r),
+        'failed': sum(1 for r in results if 'error' in r),
+        'results': results
+    })
+
+@scan_bp.route('/parse_qr/stats', methods=['GET'])
+def parse_qr_stats():
+    formats = {}
+    for fmt, entry in _stats['formats'].items():
+        count = entry['decoded'] + entry['failed']
+        formats[fmt] = dict(entry, avg_ms=entry['total_ms'] / count if count else 0.0)
+    return jsonify({
+        'cache_hits': _stats['cache_hits'],
+        'cache_misses': _stats['cache_misses'],
+        'cache_size': len(_cache),
+        'unrecognised': _stats['unrecognised'],
+        'formats': formats
+    })
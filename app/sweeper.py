@@ -0,0 +1,120 @@
+"""End-of-day sweep: expired tokens nobody called become no_show.
+
+    python -m app.sweeper [--batch N]
+
+A token's ``expires_at`` is a day after it was issued. Tokens still waiting,
+on recall or on hold past it are set to no_show, NO_SHOW_SWEEP_BATCH rows per
+UPDATE, each batch in its own short transaction so registration and
+call-next are never blocked behind the whole sweep. The displays get one
+``tokens-transitioned`` event per department. The app sweeps every
+NO_SHOW_SWEEP_INTERVAL seconds; the command line sweeps once and, with the
+event bus enabled, notifies the running workers. Without the bus it cannot
+reach them: a running server keeps showing the swept tokens (its display
+state is loaded once) until it restarts.
+"""
+import logging
+import sys
+import time
+
+from app import queries
+from app.db import get_db_connection
+from app.queue_engine import queue_engine
+from app_config import NO_SHOW_SWEEP_BATCH, NO_SHOW_SWEEP_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+def _sweep_batch(batch_size):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            queries.execute(cur, "sweep_expired", {"batch_size": batch_size})
+            return cur.fetchall()
+
+
+def sweep_expired(batch_size=NO_SHOW_SWEEP_BATCH, emit=None):
+    """Mark every expired open token no_show; returns ``{department_id: [token ids]}``.
+
+    ``emit(event, data, department_id)`` is called once per department when
+    the sweep is done.
+    """
+    swept = {}
+    on_screen = {}     # department_id -> (token number, name) of a swept token on its display
+    while True:
+        rows = _sweep_batch(batch_size)
+        for department_id, token, token_number, status_updated_at, is_current, first_name, last_name in rows:
+            swept.setdefault(department_id, []).append((token, token_number, status_updated_at))
+            if is_current:
+                on_screen[department_id] = (token_number, f"{first_name} {last_name}")
+        if len(rows) < batch_size:
+            break
+
+    for department_id, changes in swept.items():
+        queue_engine.apply_statuses(department_id, [(token, "no_show", updated_at)
+                                                    for token, _, updated_at in changes])
+        log.info("Swept expired tokens", extra={"department_id": department_id, "count": len(changes)})
+        if emit is not None:
+            emit("tokens-transitioned", {
+                "department_id": department_id,
+                "from_status": ["waiting", "recall", "hold"],
+                "to_status": "no_show",
+                "reason": "expired",
+                "count": len(changes),
+                "tokens": [token_number for _, token_number, _ in changes],
+            }, department_id)
+            if department_id in on_screen:
+                # Keep the displays (and their snapshot) from showing it as still called
+                token_number, name = on_screen[department_id]
+                emit("update-token", {
+                    "token": token_number,
+                    "name": name,
+                    "department_id": department_id,
+                    "status": "no_show"
+                }, department_id)
+    return {department_id: [token_number for _, token_number, _ in changes]
+            for department_id, changes in swept.items()}
+
+
+# ---------------- BACKGROUND JOB ----------------
+def sweep_forever(interval=NO_SHOW_SWEEP_INTERVAL):
+    from app.queue_stats import schedule_push
+    from app.realtime import safe_emit
+
+    while True:
+        try:
+            for department_id in sweep_expired(emit=safe_emit):
+                schedule_push(department_id)
+        except Exception as e:
+            log.warning("No-show sweep failed: %s", e)
+        time.sleep(interval)
+
+
+def start_sweeper(socketio):
+    if NO_SHOW_SWEEP_INTERVAL > 0:
+        socketio.start_background_task(sweep_forever)
+
+
+def main(argv):
+    from app.event_bus import bus_enabled, publish
+
+    args = argv[1:]
+    batch_size = int(args[args.index("--batch") + 1]) if "--batch" in args else NO_SHOW_SWEEP_BATCH
+    # Without the bus nothing reaches a running server from here, and its
+    # display state never reloads a department on its own
+    swept = sweep_expired(batch_size, emit=publish if bus_enabled() else None)
+    if swept and bus_enabled():
+        from app.queue_stats import fetch_queue_stats
+        for department_id, stats in fetch_queue_stats(list(swept)).items():
+            publish("queue-stats", stats, department_id)
+    for department_id, tokens in sorted(swept.items()):
+        print(f"{department_id:<8} {len(tokens)} tokens -> no_show")
+    if not swept:
+        print("No expired tokens")
+    elif not bus_enabled():
+        print("EVENT_BUS is not postgres: restart the app for its displays to show this sweep")
+    return 0
+
+
+if __name__ == "__main__":
+    from app.log import configure_logging
+    configure_logging()
+    sys.exit(main(sys.argv))
@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, request
+
+
+# ---------------- PER-DEPARTMENT DEBOUNCE ----------------
+class Debouncer:
+    """Accept at most one request per ``interval`` seconds for each (name, department).
+
+    Endpoints that share a name share the limit, so call-next and move-next
+    count as the same button. State is per worker process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = {}       # (name, department_id) -> monotonic time accepted
+        self._stats = {}      # name -> {"accepted", "limited"}
+
+    def check(self, name, department_id, interval):
+        """Return 0 if the request may go ahead, else seconds until it may."""
+        key = (name, str(department_id))
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats.setdefault(name, {"accepted": 0, "limited": 0})
+            last = self._last.get(key)
+            if last is not None and now - last < interval:
+                stats["limited"] += 1
+                return interval - (now - last)
+            self._last[key] = now
+            stats["accepted"] += 1
+            return 0
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+debouncer = Debouncer()
+
+
+def debounce(name, interval_ms):
+    """Reject repeats for the same ``department_id`` (JSON body) with 429 and Retry-After."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            department_id = data.get("department_id")
+            if interval_ms > 0 and department_id:
+                wait = debouncer.check(name, department_id, interval_ms / 1000)
+                if wait:
+                    retry_after = max(1, math.ceil(wait))
+                    response = jsonify({"error": "Too many requests", "retry_after": retry_after})
+                    response.headers["Retry-After"] = str(retry_after)
+                    return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------- ADMISSION CONTROL ----------------
+class AdmissionQueue:
+    """Run at most ``limit`` requests at once; up to ``queue_size`` more wait for a slot.
+
+    A request that finds the queue full, or does not get a slot within
+    ``timeout`` seconds, is turned away (503) instead of piling up behind the
+    others, so latency stays bounded when clients retry in bursts. State is
+    per worker process.
+    """
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self._service_time = None   # moving average, seconds
+        self._stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    def _retry_after(self):
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil((self.waiting + 1) * service_time / self.limit))
+
+    def acquire(self):
+        """Return 0 once a slot is taken, else the suggested Retry-After in seconds."""
+        with self._cond:
+            if self.running < self.limit:
+                self.running += 1
+                self._stats["admitted"] += 1
+                return 0
+            if self.waiting >= self.queue_size:
+                self._stats["rejected_full"] += 1
+                return self._retry_after()
+
+            self.waiting += 1
+            self._stats["queued"] += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.running >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["rejected_timeout"] += 1
+                        return self._retry_after()
+                    self._cond.wait(remaining)
+                self.running += 1
+                self._stats["admitted"] += 1
+                return 0
+            finally:
+                self.waiting -= 1
+
+    def release(self, elapsed):
+        with self._cond:
+            self.running -= 1
+            self._service_time = elapsed if self._service_time is None else \
+                self._service_time + 0.2 * (elapsed - self._service_time)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, limit=self.limit, queue_size=self.queue_size, running=self.running,
+                        waiting=self.waiting, service_time=self._service_time)
+
+
+def admit(queue):
+    """Run the view only with a slot from ``queue``; otherwise 503 with Retry-After."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if queue.limit <= 0:
+                return view(*args, **kwargs)
+            wait = queue.acquire()
+            if wait:
+                response = jsonify({"error": "Server busy, retry later", "retry_after": wait})
+                response.headers["Retry-After"] = str(wait)
+                return response, 503
+            started = time.monotonic()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                queue.release(time.monotonic() - started)
+        return wrapper
+    return decorator
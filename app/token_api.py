@@ -1,15 +1,43 @@
-from flask import Blueprint, request, jsonify
-import qrcode
+from flask import Blueprint, Response, request, jsonify, send_file, url_for
+import hashlib
 import io
+import logging
 import uuid
 import time
-from base64 import b64encode
-from PIL import Image, ImageDraw, ImageFont
-import psycopg2
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timedelta
-from db_config import DB_HOST, DB_NAME, DB_USER, DB_PASS
+from psycopg2.extras import execute_values
+from app import queries
+from app.db import get_db_connection
+from app.card_render import render_card, submit_render, card_cache
+from app.department_cache import department_cache
+from app.queue_engine import queue_engine
+from app.queue_stats import schedule_push
+from app.idempotency import idempotent, idempotency_stats
+from app.throttle import AdmissionQueue, admit
+from app_config import REGISTER_CONCURRENCY, REGISTER_QUEUE_SIZE, REGISTER_QUEUE_TIMEOUT
 
 token_bp = Blueprint('token_bp', __name__)
+log = logging.getLogger(__name__)
+
+# ----------------- DAILY TOKEN NUMBERS --------------------
+MAX_BATCH_SIZE = 1000
+
+def allocate_token_numbers(cur, department_id, day, count=1):
+    """Reserve ``count`` consecutive daily numbers and return the first one.
+
+    The per-(department, day) counter row is bumped in place, so concurrent
+    registrations get distinct numbers without scanning the day's tokens.
+    """
+    params = {"count": count, "department_id": department_id, "day": day}
+    queries.execute(cur, "bump_token_counter", params)
+    row = cur.fetchone()
+    if row is None:
+        day_start = datetime.combine(day, datetime.min.time())
+        queries.execute(cur, "seed_token_counter",
+                        dict(params, day_start=day_start, day_end=day_start + timedelta(days=1)))
+        row = cur.fetchone()
+    return row[0] - count + 1
 
 # ----------------- DB INSERT --------------------
 def insert_token_to_db(token, patient_id, department_id, dt_str):
@@ -17,57 +45,60 @@ def insert_token_to_db(token, patient_id, department_id, dt_str):
     expires_at = dt + timedelta(days=1)
     today = dt.date()
 
-    conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT COALESCE(MAX(id), 0) FROM patient_tokens
-        WHERE DATE(datetime) = %s AND department_id = %s
-    """, (today, department_id))
-    max_id_today = cur.fetchone()[0]
-    new_id = max_id_today + 1
-
-    cur.execute("""
-        INSERT INTO patient_tokens 
-        (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    """, (token, new_id, patient_id, department_id, dt, expires_at, 'waiting', datetime.now()))
-
-    conn.commit()
-    cur.close()
-    conn.close()
-    return new_id, dt, expires_at
+    now = datetime.now()
 
-# ---------------- QR IMAGE GENERATOR ----------------
-def generate_qr_card_image(patient_id, name, department_name, valid_till, id, qr_url):
-    qr = qrcode.make(qr_url)
-    qr = qr.resize((200, 200))
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            new_id = allocate_token_numbers(cur, department_id, today)
 
-    card = Image.new("RGB", (400, 400), color="white")
-    draw = ImageDraw.Draw(card)
+            queries.execute(cur, "insert_token", {
+                "token": token, "id": new_id, "patient_id": patient_id, "department_id": department_id,
+                "datetime": dt, "expires_at": expires_at, "now": now,
+            })
 
-    try:
-        font = ImageFont.truetype("arial.ttf", 12)
-    except:
-        font = ImageFont.load_default()
+    queue_engine.add_token(department_id, token, 'waiting', now, dt)
+    schedule_push(department_id)
+    return new_id, dt, expires_at
 
-    qr_x = (card.width - qr.width) // 2
-    card.paste(qr, (qr_x, 10))
+def insert_tokens_batch(patient_ids, department_id, dt_str):
+    dt = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M")
+    expires_at = dt + timedelta(days=1)
+    now = datetime.now()
+    tokens = [str(uuid.uuid4()) for _ in patient_ids]
 
-    text_y_start = 230
-    line_height = 20
-    draw.text((20, text_y_start + 0 * line_height), f"Patient ID: {patient_id}", fill="black", font=font)
-    draw.text((20, text_y_start + 1*line_height), f"Name: {name}", fill="black", font=font)
-    draw.text((20, text_y_start + 2*line_height), f"Department: {department_name}", fill="black", font=font)
-    draw.text((20, text_y_start + 3 * line_height), f"Valid till: {valid_till.strftime('%Y-%m-%d %H:%M')}", fill="black", font=font)
-    draw.text((20, text_y_start + 4 * line_height), f"Token number: {id}", fill="black", font=font)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            first_id = allocate_token_numbers(cur, department_id, dt.date(), len(patient_ids))
+            rows = [
+                (token, first_id + i, patient_id, department_id, dt, expires_at, 'waiting', now)
+                for i, (token, patient_id) in enumerate(zip(tokens, patient_ids))
+            ]
+            execute_values(cur, """
+                INSERT INTO patient_tokens
+                (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
+                VALUES %s
+            """, rows, page_size=len(rows))
 
-    buf = io.BytesIO()
-    card.save(buf, format="PNG")
-    return b64encode(buf.getvalue()).decode("utf-8")
+    for token in tokens:
+        queue_engine.add_token(department_id, token, 'waiting', now, dt)
+    schedule_push(department_id)
+
+    return [
+        {"token": token, "daily_id": first_id + i, "patient_id": patient_id}
+        for i, (token, patient_id) in enumerate(zip(tokens, patient_ids))
+    ], dt, expires_at
+
+# ---------------- QR IMAGE GENERATOR ----------------
+QR_URL_TEMPLATE = "https://megha-dev.sirobilt.com/patient/{patient_id}"
 
 # ---------------- REGISTER API ----------------
+# Token inserts and card renders share a bounded number of slots; retries
+# with the same Idempotency-Key are answered before taking one
+register_admission = AdmissionQueue(REGISTER_CONCURRENCY, REGISTER_QUEUE_SIZE, REGISTER_QUEUE_TIMEOUT)
+
 @token_bp.route("/register", methods=["POST"])
+@idempotent("register")
+@admit(register_admission)
 def register():
     try:
         data = request.get_json()
@@ -77,23 +108,119 @@ def register():
         department_name = data["department_name"]
         datetime_str = data["date_time"]
 
+        # "card": "url" returns a link to /token/<uuid>/card.png instead of inline base64
+        card_format = data.get("card", request.args.get("card", "base64"))
+
         token = str(uuid.uuid4())
         daily_id, dt, expires_at = insert_token_to_db(token, patient_id, department_id, datetime_str)
 
-        qr_url = f"https://megha-dev.sirobilt.com/patient/{patient_id}"
-        qr_card_b64 = generate_qr_card_image(patient_id, name, department_name, expires_at, daily_id, qr_url)
+        qr_url = QR_URL_TEMPLATE.format(patient_id=patient_id)
+        card_args = (patient_id, name, department_name, expires_at, daily_id, qr_url)
 
-        return jsonify({
+        response = {
             "message": "Patient registered successfully",
             "token": token,
             "verify_url": qr_url,
-            "qr_card_base64": qr_card_b64,
             "daily_id": daily_id,
             "patient": {
                 "patient_id": patient_id,
                 "department_id": department_id,
                 "datetime": datetime_str
             }
+        }
+        if card_format == "url":
+            # Render in the background; a GET for the card waits on this render
+            card_cache.put_pending(token, submit_render(*card_args), expires_at)
+            response["qr_card_url"] = url_for("token_bp.get_token_card", token=token, _external=True)
+        else:
+            try:
+                png = render_card(*card_args)
+                card_cache.put(token, png, expires_at)
+            except Exception as e:
+                # The token is already committed; a 5xx would release the
+                # Idempotency-Key and the kiosk's retry would register again
+                log.warning("Card render failed, returning its URL: %s", e,
+                            extra={"department_id": department_id, "sample": "register_card_failed"})
+                response["qr_card_url"] = url_for("token_bp.get_token_card", token=token, _external=True)
+            else:
+                response["qr_card_base64"] = b64encode(png).decode("utf-8")
+
+        return jsonify(response), 201
+
+    except KeyError as e:
+        return jsonify({"error": f"Missing field: {e}"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ---------------- QR CARD API ----------------
+def fetch_card_details(token):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            queries.execute(cur, "card_details", {"token": token})
+            return cur.fetchone()
+
+@token_bp.route("/token/<uuid:token>/card.png", methods=["GET"])
+def get_token_card(token):
+    token = str(token)
+    cached = card_cache.get(token)
+
+    if cached is not None:
+        png, expires_at = cached
+    else:
+        row = fetch_card_details(token)
+        if row is None:
+            return jsonify({"error": "Unknown token"}), 404
+        daily_id, patient_id, department_id, expires_at, first_name, last_name = row
+        name = " ".join(filter(None, [first_name, last_name]))
+        png = render_card(patient_id, name, department_cache.name(department_id), expires_at, daily_id,
+                          QR_URL_TEMPLATE.format(patient_id=patient_id))
+        card_cache.put(token, png, expires_at)
+
+    # A token's card never changes, so clients may keep it until the token expires
+    max_age = max(0, int((expires_at - datetime.now()).total_seconds()))
+    response = send_file(io.BytesIO(png), mimetype="image/png", etag=token, max_age=max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@token_bp.route("/token/card-cache", methods=["GET"])
+def card_cache_stats():
+    return jsonify(card_cache.stats()), 200
+
+@token_bp.route("/register/admission", methods=["GET"])
+def register_admission_stats():
+    return jsonify({"admission": register_admission.stats(), "idempotency": dict(idempotency_stats)}), 200
+
+# ---------------- BATCH REGISTER API ----------------
+@token_bp.route("/register/batch", methods=["POST"])
+@idempotent("register_batch")
+@admit(register_admission)
+def register_batch():
+    try:
+        data = request.get_json()
+        department_id = data["department_id"]
+        datetime_str = data["date_time"]
+        patients = data["patients"]
+
+        if not isinstance(patients, list) or not patients:
+            return jsonify({"error": "patients must be a non-empty list"}), 400
+        if len(patients) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} patients per batch"}), 400
+
+        for i, p in enumerate(patients):
+            patient_id = p.get("patient_id") if isinstance(p, dict) else None
+            if isinstance(patient_id, bool) or not isinstance(patient_id, (str, int)) or patient_id == "":
+                return jsonify({"error": f"patients[{i}] must be an object with a patient_id"}), 400
+
+        patient_ids = [p["patient_id"] for p in patients]
+        tokens, dt, expires_at = insert_tokens_batch(patient_ids, department_id, datetime_str)
+
+        return jsonify({
+            "message": f"{len(tokens)} patients registered successfully",
+            "department_id": department_id,
+            "datetime": datetime_str,
+            "expires_at": expires_at.strftime("%Y-%m-%d %H:%M"),
+            "tokens": tokens
         }), 201
 
     except KeyError as e:
@@ -102,41 +229,113 @@ def register():
         return jsonify({"error": str(e)}), 500
 
 # ---------------- QUEUE API ----------------
+# Dashboards poll this every few seconds. Pass ?since=<cursor> (empty for the
+# start of the day) to get only the rows changed after the cursor, ordered by
+# (status_updated_at, token) and paged with ?limit=; every response carries the
+# cursor for the next poll. ?format=columns returns parallel arrays instead of
+# one dict per row. Responses carry an ETag derived from the day's rows, so an
+# unchanged queue costs one aggregate query and a 304.
+QUEUE_PAGE_DEFAULT = 500
+QUEUE_PAGE_MAX = 1000
+# Rows stamped within this many seconds of "now" are sent again on the next
+# poll: status_updated_at is taken before commit, so a slow transaction can
+# land behind a cursor that has already moved past its timestamp.
+QUEUE_CURSOR_SETTLE = 5
+QUEUE_COLUMNS = ["id", "token", "patient_id", "datetime", "status", "status_updated_at"]
+NIL_TOKEN = "00000000-0000-0000-0000-000000000000"
+
+def encode_queue_cursor(updated_at, token):
+    return urlsafe_b64encode(f"{updated_at}|{token}".encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_queue_cursor(cursor):
+    """Returns ``(status_updated_at, token)``; an empty cursor means the start of the day."""
+    if not cursor:
+        return datetime.min, NIL_TOKEN
+    try:
+        updated_at, token = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8").split("|")
+        return datetime.fromisoformat(updated_at), str(uuid.UUID(token))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+def fetch_queue_rows(cur, params, since, limit):
+    if since is None:
+        queries.execute(cur, "queue_rows", params)
+        return cur.fetchall()
+    queries.execute(cur, "queue_changes", dict(params, since_at=since[0], since_token=since[1], limit=limit + 1))
+    return cur.fetchall()
+
+def next_queue_cursor(rows, since, has_more, now):
+    if not rows:
+        return encode_queue_cursor(*since) if since else None
+    last_at = datetime.fromisoformat(rows[-1][6])
+    if has_more:
+        return encode_queue_cursor(last_at, rows[-1][1])
+    settled = now - timedelta(seconds=QUEUE_CURSOR_SETTLE)
+    if since is None:
+        # Full listing is ordered by id, so the newest change is not the last row
+        last_at = max(datetime.fromisoformat(row[6]) for row in rows)
+        return encode_queue_cursor(min(last_at, settled), NIL_TOKEN)
+    if last_at > settled:
+        return encode_queue_cursor(settled, NIL_TOKEN)
+    return encode_queue_cursor(last_at, rows[-1][1])
+
 @token_bp.route("/queue/<int:department_id>", methods=["GET"])
 def get_department_queue(department_id):
     try:
-        today = datetime.today().date()
-        conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor()
-
-        cur.execute("""
-            SELECT id, token, patient_id, datetime, status, status_updated_at
-            FROM patient_tokens
-            WHERE department_id = %s AND DATE(datetime) = %s
-            ORDER BY id ASC
-        """, (department_id, today))
-
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-
-        queue = [
-            {
-                "id": row[0],
-                "token": row[1],
-                "patient_id": row[2],
-                "datetime": row[3].strftime("%Y-%m-%d %H:%M"),
-                "status": row[4],
-                "status_updated_at": row[5].strftime("%Y-%m-%d %H:%M:%S")
-            }
-            for row in rows
-        ]
+        since_arg = request.args.get("since")
+        if since_arg is None and "limit" in request.args:
+            # A page size asks for pages, starting from the beginning of the day
+            since_arg = ""
+        since = decode_queue_cursor(since_arg) if since_arg is not None else None
+        limit = request.args.get("limit", QUEUE_PAGE_DEFAULT, type=int)
+        if not 1 <= limit <= QUEUE_PAGE_MAX:
+            return jsonify({"error": f"limit must be between 1 and {QUEUE_PAGE_MAX}"}), 400
+        columnar = request.args.get("format") == "columns"
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        return jsonify({
+    try:
+        now = datetime.now()
+        today = now.date()
+        day_start = datetime.combine(today, datetime.min.time())
+        params = {"department_id": str(department_id), "day_start": day_start,
+                  "day_end": day_start + timedelta(days=1)}
+
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                queries.execute(cur, "queue_signature", params)
+                count, checksum = cur.fetchone()
+                etag = hashlib.sha1(
+                    f"{today}:{count}:{checksum}:{since_arg}:{limit}:{columnar}".encode("utf-8")).hexdigest()
+                if request.if_none_match.contains(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    response.headers["Cache-Control"] = "no-cache"
+                    return response
+
+                rows = fetch_queue_rows(cur, params, since, limit)
+
+        has_more = since is not None and len(rows) > limit
+        rows = rows[:limit] if since is not None else rows
+
+        if columnar:
+            queue = {name: [row[i] for row in rows] for i, name in enumerate(QUEUE_COLUMNS)}
+        else:
+            queue = [dict(zip(QUEUE_COLUMNS, row)) for row in rows]
+
+        payload = {
             "department_id": department_id,
             "date": today.strftime("%Y-%m-%d"),
-            "queue": queue
-        }), 200
+            "queue": queue,
+            "cursor": next_queue_cursor(rows, since, has_more, now)
+        }
+        if since is not None:
+            payload["has_more"] = has_more
+
+        response = jsonify(payload)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response, 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -0,0 +1,83 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seconds the specializations table is cached in-process (app/department_cache.py)
+DEPARTMENT_CACHE_TTL = float(os.getenv("DEPARTMENT_CACHE_TTL", "3600"))
+
+# How Socket.IO events reach clients: "local" emits from this process only;
+# "postgres" publishes through NOTIFY so every worker re-emits (app/event_bus.py)
+EVENT_BUS = os.getenv("EVENT_BUS", "local")
+EVENT_CHANNEL = os.getenv("EVENT_CHANNEL", "regai_events")
+
+# QR card rendering (app/card_render.py). 0 workers renders in-process.
+CARD_RENDER_WORKERS = int(os.getenv("CARD_RENDER_WORKERS", "2"))
+CARD_RENDER_TIMEOUT = float(os.getenv("CARD_RENDER_TIMEOUT", "10"))
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "512"))
+CARD_CACHE_DIR = os.getenv("CARD_CACHE_DIR")
+CARD_FONT = os.getenv("CARD_FONT", "arial.ttf")
+
+# Apply pending schema migrations (app/migrations.py) when the app starts
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "0") == "1"
+
+# "memory" keeps per-department next-patient heaps in-process (app/queue_engine.py);
+# "off" selects every next patient with SQL. Only used with EVENT_BUS=local.
+QUEUE_ENGINE = os.getenv("QUEUE_ENGINE", "memory")
+
+# Log requests slower than this many milliseconds with their SQL breakdown
+# (app/metrics.py); 0 disables the slow-request log
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+# Logging (app/log.py). LOG_LEVELS overrides single modules, e.g.
+# "app.scan_api=DEBUG,app.realtime=WARNING"; LOG_FORMAT is "json" or "text".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "10"))
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", "60"))
+
+# Token updates for one department within this many milliseconds are collapsed
+# into the latest one (app/realtime.py); 0 emits every update
+EMIT_COALESCE_MS = float(os.getenv("EMIT_COALESCE_MS", "250"))
+
+# Minimum milliseconds between accepted call-next/move-next (shared) and
+# announce-current requests for one department; faster repeats get a 429
+CALL_MIN_INTERVAL_MS = float(os.getenv("CALL_MIN_INTERVAL_MS", "1000"))
+ANNOUNCE_MIN_INTERVAL_MS = float(os.getenv("ANNOUNCE_MIN_INTERVAL_MS", "3000"))
+
+# Daily patient_tokens partitions (app/partitions.py): how many days ahead to
+# create, how often the app creates/archives them (seconds, 0 disables) and,
+# if set, a directory expired days are written to instead of patient_tokens_archive
+PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", "7"))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR")
+
+# How often the app marks expired waiting/recall/hold tokens no_show (seconds,
+# 0 disables; app/sweeper.py) and how many rows each UPDATE touches
+NO_SHOW_SWEEP_INTERVAL = float(os.getenv("NO_SHOW_SWEEP_INTERVAL", "900"))
+NO_SHOW_SWEEP_BATCH = int(os.getenv("NO_SHOW_SWEEP_BATCH", "500"))
+
+# /register and /register/batch (app/throttle.py): how many run at once per
+# worker, how many more may wait for a slot and for how long (seconds); the
+# rest get 503 with Retry-After. 0 disables the limit.
+REGISTER_CONCURRENCY = int(os.getenv("REGISTER_CONCURRENCY", "4"))
+REGISTER_QUEUE_SIZE = int(os.getenv("REGISTER_QUEUE_SIZE", "16"))
+REGISTER_QUEUE_TIMEOUT = float(os.getenv("REGISTER_QUEUE_TIMEOUT", "5"))
+
+# Responses to requests carrying an Idempotency-Key are replayed to retries
+# with the same key for this many seconds (app/idempotency.py); 0 disables
+IDEMPOTENCY_WINDOW = int(os.getenv("IDEMPOTENCY_WINDOW", "3600"))
+# A request still running with a key holds it this many seconds; after that a
+# retry takes it over (the first request crashed or its worker died)
+IDEMPOTENCY_LEASE = int(os.getenv("IDEMPOTENCY_LEASE", "30"))
+
+# Which parts of the app this process serves (app/__init__.py): any of
+# "display" (screens, call-next, announcements), "registration" (/register,
+# QR cards, /queue) and "scanner" (QR parsing), comma separated
+APP_ROLES = os.getenv("APP_ROLES", "display,registration,scanner")
+
+# PREPARE the hot statements once per pooled connection (app/queries.py); set
+# to 0 behind a transaction-mode connection pooler such as PgBouncer
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"
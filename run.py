@@ -1,9 +1,10 @@
 import eventlet
 eventlet.monkey_patch()
 
+import os
 from app import create_app, socketio
 
 app = create_app()
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
\ No newline at end of file
@@ -0,0 +1,384 @@
+"""Load-test the token lifecycle and report latency, throughput and DB round trips.
+
+Seeds benchmark departments and patients, starts ``run.py`` (or targets an
+already running server with --url), then drives each scenario in turn at the
+requested concurrency:
+
+    register    POST /register
+    queue       GET  /queue/<department_id>
+    call_next   POST /api/call-next
+    move_next   POST /api/move-next
+    parse_qr    POST /parse_qr (plain XML and ABHA payloads)
+
+While call_next/move_next run, --displays Socket.IO clients subscribe to the
+benchmark departments and measure the time from sending the request to
+receiving the 'update-token' for the token the response names. DB round trips per request come from the
+server's /api/db-pool counters, so only one worker may serve the benchmark.
+The report is JSON, so runs against different versions can be diffed:
+
+    python scripts/benchmark.py --requests 500 --concurrency 16 --output before.json
+
+Database settings come from DB_* / .env as for the app. --embedded DIR starts
+a throwaway Postgres in DIR instead (pip install pgserver).
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SCENARIOS = ["register", "queue", "call_next", "move_next", "parse_qr"]
+
+
+# ---------------- DATABASE ----------------
+def start_embedded(pgdata):
+    import pgserver
+
+    server = pgserver.get_server(pgdata)
+    uri = urllib.parse.urlparse(server.get_uri())
+    query = urllib.parse.parse_qs(uri.query)
+    os.environ.update({
+        "DB_HOST": query.get("host", [uri.hostname or "localhost"])[0],
+        "DB_NAME": uri.path.lstrip("/") or "postgres",
+        "DB_USER": uri.username or "postgres",
+        "DB_PASS": uri.password or "",
+    })
+    return server
+
+
+def connect():
+    import psycopg2
+
+    return psycopg2.connect(host=os.getenv("DB_HOST"), dbname=os.getenv("DB_NAME"),
+                            user=os.getenv("DB_USER"), password=os.getenv("DB_PASS"))
+
+
+def seed(departments, patients, first_department, backlog):
+    """Create the benchmark departments/patients and reset their tokens for today.
+
+    Each department starts with ``backlog`` waiting tokens so call-next and
+    move-next have patients to call regardless of the register scenario.
+    """
+    subprocess.run([sys.executable, "-m", "app.migrations", "apply"], cwd=ROOT, env=os.environ, check=True)
+
+    # /queue/<department_id> only routes numeric ids
+    department_ids = [str(first_department + i) for i in range(departments)]
+    patient_ids = [f"BENCH{i}" for i in range(1, patients + 1)]
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            # Reference tables normally belong to the hospital system; create
+            # minimal ones when benchmarking against an empty database
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS specializations (
+                    specialization_id VARCHAR(50) PRIMARY KEY, name TEXT NOT NULL)
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS patients (
+                    patient_id VARCHAR(50) PRIMARY KEY, first_name TEXT, last_name TEXT)
+            """)
+            cur.executemany("""
+                INSERT INTO specializations (specialization_id, name) VALUES (%s, %s)
+                ON CONFLICT (specialization_id) DO NOTHING
+            """, [(d, f"Benchmark {d}") for d in department_ids])
+            cur.executemany("""
+                INSERT INTO patients (patient_id, first_name, last_name) VALUES (%s, %s, %s)
+                ON CONFLICT (patient_id) DO NOTHING
+            """, [(p, "Bench", p) for p in patient_ids])
+            cur.execute("DELETE FROM current_token WHERE department_id = ANY(%s)", (department_ids,))
+            cur.execute("DELETE FROM patient_tokens WHERE department_id = ANY(%s)", (department_ids,))
+            cur.execute("DELETE FROM token_counters WHERE department_id = ANY(%s)", (department_ids,))
+            # Earlier runs' consult averages would skew the estimated waits
+            cur.execute("DELETE FROM queue_stats WHERE department_id = ANY(%s)", (department_ids,))
+            if backlog:
+                cur.execute("""
+                    INSERT INTO patient_tokens
+                    (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
+                    SELECT gen_random_uuid(), n, (%s::varchar[])[1 + (n * 7919) %% %s], d,
+                           date_trunc('minute', now()), date_trunc('minute', now()) + interval '1 day',
+                           'waiting', now() - interval '1 hour' + n * interval '1 second'
+                    FROM unnest(%s::varchar[]) AS d, generate_series(1, %s) AS n
+                """, (patient_ids, len(patient_ids), department_ids, backlog))
+                cur.execute("""
+                    INSERT INTO token_counters (department_id, day, last_value)
+                    SELECT d, CURRENT_DATE, %s FROM unnest(%s::varchar[]) AS d
+                """, (backlog, department_ids))
+        conn.commit()
+    finally:
+        conn.close()
+    return department_ids, patient_ids
+
+
+# ---------------- SERVER ----------------
+def start_server(port):
+    env = dict(os.environ, PORT=str(port), EVENT_BUS="local")
+    # The scenarios press call-next far faster than a doctor would
+    env.setdefault("CALL_MIN_INTERVAL_MS", "0")
+    env.setdefault("ANNOUNCE_MIN_INTERVAL_MS", "0")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "run.py")], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + "/api/db-pool", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+def request(url, payload=None):
+    data = None
+    headers = {}
+    if payload is not None:
+        data = json.dumps(payload).encode()
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=data, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def round_trips(url):
+    _, body = request(url + "/api/db-pool")
+    return json.loads(body).get("round_trips", {})
+
+
+# ---------------- DISPLAY CLIENTS ----------------
+class Displays:
+    """Socket.IO clients that timestamp every 'update-token' they receive."""
+
+    def __init__(self, url, count, department_ids):
+        import socketio
+
+        self.received = {}     # (display, department_id, token) -> [monotonic receive times]
+        self.lock = threading.Lock()
+        self.clients = []
+        for index in range(count):
+            client = socketio.Client()
+            client.on("update-token", lambda data, index=index: self._on_update(index, data))
+            client.connect(f"{url}?department_id={','.join(department_ids)}", transports=["websocket"])
+            self.clients.append(client)
+
+    def _on_update(self, index, data):
+        at = time.monotonic()
+        key = (index, str(data.get("department_id")), data.get("token"))
+        with self.lock:
+            self.received.setdefault(key, []).append(at)
+
+    def latencies(self, sent):
+        """Emit-to-receive latency in ms: the first matching event each display got after the request."""
+        latencies = []
+        with self.lock:
+            for (department_id, token), sent_at in sent.items():
+                for index in range(len(self.clients)):
+                    times = [at for at in self.received.get((index, department_id, token), []) if at >= sent_at]
+                    if times:
+                        latencies.append((min(times) - sent_at) * 1000)
+        return latencies
+
+    def close(self):
+        for client in self.clients:
+            client.disconnect()
+
+
+# ---------------- SCENARIOS ----------------
+def plain_qr(i):
+    return (f'<PrintLetterBarcodeData uid="XXXXXXXX{i:04d}" name="Bench Patient {i}" gender="F" '
+            f'yob="1990" house="{i}" loc="Main Road" vtc="Shillong" dist="East Khasi Hills" '
+            f'state="Meghalaya" pc="793001"/>')
+
+
+def abha_qr(i):
+    return json.dumps({"hidn": f"91-0000-0000-{i:04d}", "name": f"Bench Patient {i}",
+                       "gender": "M", "dob": "01-01-1985", "address": "Shillong, Meghalaya"})
+
+
+def build_jobs(scenario, url, args, department_ids, patient_ids, rng):
+    jobs = []
+    for i in range(args.requests):
+        department_id = department_ids[i % len(department_ids)]
+        if scenario == "register":
+            payload = {
+                "patient_id": rng.choice(patient_ids),
+                "name": "Bench Patient",
+                "department_id": department_id,
+                "department_name": f"Benchmark {department_id}",
+                "date_time": datetime.now().strftime("%Y-%m-%dT%H:%M"),
+                "card": args.card,
+            }
+            jobs.append((department_id, url + "/register", payload))
+        elif scenario == "queue":
+            jobs.append((department_id, f"{url}/queue/{department_id}", None))
+        elif scenario in ("call_next", "move_next"):
+            path = "/api/call-next" if scenario == "call_next" else "/api/move-next"
+            jobs.append((department_id, url + path, {"department_id": department_id}))
+        elif scenario == "parse_qr":
+            qr = plain_qr(i) if i % 2 else abha_qr(i)
+            jobs.append((department_id, url + "/parse_qr", {"qrData": qr}))
+    return jobs
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(values)) - 1)  # nearest rank
+    return round(values[index], 2)
+
+
+def summarize(latencies):
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": round(max(latencies), 2) if latencies else None,
+        "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+    }
+
+
+def run_scenario(scenario, url, args, department_ids, patient_ids, rng, displays):
+    jobs = build_jobs(scenario, url, args, department_ids, patient_ids, rng)
+    latencies = []
+    statuses = {}
+    sent = {}
+    lock = threading.Lock()
+
+    def call(job):
+        department_id, target, payload = job
+        started = time.monotonic()
+        status, body = request(target, payload)
+        elapsed = (time.monotonic() - started) * 1000
+        token = None
+        if scenario in ("call_next", "move_next") and status == 200:
+            token = json.loads(body).get("token")
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if token is not None:
+                sent[(department_id, token)] = started
+
+    before = round_trips(url)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(call, jobs))
+    duration = time.monotonic() - started
+    after = round_trips(url)
+
+    # The two /api/db-pool calls themselves make no database round trips
+    delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    result = {
+        "requests": len(jobs),
+        "concurrency": args.concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(jobs) / duration, 1) if duration else None,
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "latency_ms": summarize(latencies),
+        "db_round_trips_per_request": round(delta.get("total", 0) / len(jobs), 2) if jobs else None,
+        "db_statements_per_request": round(delta.get("statements", 0) / len(jobs), 2) if jobs else None,
+    }
+    if displays is not None and scenario in ("call_next", "move_next"):
+        time.sleep(args.settle)
+        emit_latencies = displays.latencies(sent)
+        result["emit_to_receive_ms"] = dict(summarize(emit_latencies), samples=len(emit_latencies))
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of starting run.py")
+    parser.add_argument("--port", type=int, default=5200)
+    parser.add_argument("--embedded", metavar="DIR", help="start a throwaway Postgres in DIR (needs pgserver)")
+    parser.add_argument("--departments", type=int, default=4)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--first-department", type=int, default=9001,
+                        help="seeded departments get consecutive ids from this one")
+    parser.add_argument("--backlog", type=int, default=200, help="waiting tokens seeded per department")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--displays", type=int, default=4, help="Socket.IO display clients (0 to skip)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--card", choices=["base64", "url"], default="base64", help="card format for /register")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait for trailing emits")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for patient selection")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    embedded = start_embedded(args.embedded) if args.embedded else None
+    department_ids, patient_ids = seed(args.departments, args.patients, args.first_department, args.backlog)
+
+    server = None
+    url = args.url.rstrip("/") if args.url else f"http://127.0.0.1:{args.port}"
+    if not args.url:
+        server = start_server(args.port)
+    displays = None
+    try:
+        wait_until_up(url)
+        if args.displays:
+            displays = Displays(url, args.displays, department_ids)
+            time.sleep(0.5)  # let the room joins land
+
+        rng = random.Random(args.seed)
+        results = {}
+        for scenario in scenarios:
+            results[scenario] = run_scenario(scenario, url, args, department_ids, patient_ids, rng, displays)
+
+        report = {
+            "revision": git_revision(),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {
+                "departments": args.departments,
+                "patients": args.patients,
+                "backlog": args.backlog,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "displays": args.displays,
+                "card": args.card,
+            },
+            "scenarios": results,
+        }
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if displays is not None:
+            displays.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if embedded is not None:
+            embedded.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Precompute the compressed announcement chime served to the displays.
+
+    python scripts/build_assets.py
+
+Encodes static/mixkit-home-standard-ding-dong-109.wav (44.1 kHz stereo PCM,
+~700 KB) to a mono 64 kbit/s static/chime.mp3 with ffmpeg (found on PATH or
+via $FFMPEG). Without ffmpeg it falls back to static/chime.wav, downmixed to
+mono and resampled to 22.05 kHz with the standard library (~4x smaller).
+The displays load whichever exists (app/assets.py adds fingerprints,
+compression and cache headers at startup).
+"""
+import argparse
+import array
+import os
+import shutil
+import subprocess
+import sys
+import wave
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+STATIC = os.path.join(ROOT, "static")
+SOURCE = os.path.join(STATIC, "mixkit-home-standard-ding-dong-109.wav")
+
+
+def encode_mp3(ffmpeg, source, target, bitrate):
+    subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", source,
+                    "-ac", "1", "-codec:a", "libmp3lame", "-b:a", bitrate, "-map_metadata", "-1", target],
+                   check=True)
+
+
+def downsample_wav(source, target, rate=22050):
+    """Mono 16-bit PCM at ``rate`` Hz, resampled by linear interpolation."""
+    with wave.open(source, "rb") as src:
+        channels, width, src_rate, frames = src.getnchannels(), src.getsampwidth(), src.getframerate(), src.getnframes()
+        if width != 2:
+            raise ValueError("expected 16-bit PCM, got %d-bit" % (width * 8))
+        samples = array.array("h", src.readframes(frames))
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    mono = [sum(samples[i:i + channels]) // channels for i in range(0, len(samples), channels)]
+    step = src_rate / rate
+    out = array.array("h")
+    for n in range(int(len(mono) / step)):
+        pos = n * step
+        i = int(pos)
+        nxt = mono[i + 1] if i + 1 < len(mono) else mono[i]
+        out.append(int(mono[i] + (nxt - mono[i]) * (pos - i)))
+    if sys.byteorder == "big":
+        out.byteswap()
+
+    with wave.open(target, "wb") as dst:
+        dst.setnchannels(1)
+        dst.setsampwidth(2)
+        dst.setframerate(rate)
+        dst.writeframes(out.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default=SOURCE)
+    parser.add_argument("--bitrate", default="64k", help="MP3 bitrate (ffmpeg only)")
+    parser.add_argument("--ffmpeg", default=os.getenv("FFMPEG") or shutil.which("ffmpeg"))
+    args = parser.parse_args()
+
+    if args.ffmpeg:
+        target = os.path.join(STATIC, "chime.mp3")
+        encode_mp3(args.ffmpeg, args.source, target, args.bitrate)
+    else:
+        print("ffmpeg not found; writing a downsampled WAV instead", file=sys.stderr)
+        target = os.path.join(STATIC, "chime.wav")
+        downsample_wav(args.source, target)
+    print(f"{os.path.relpath(target, ROOT)}: {os.path.getsize(args.source)} -> {os.path.getsize(target)} bytes")
+
+
+if __name__ == "__main__":
+    main()
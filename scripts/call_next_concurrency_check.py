@@ -0,0 +1,150 @@
+"""Check that concurrent call-next transitions never assign one token twice.
+
+Seeds --tokens waiting tokens for a scratch department, then runs the same
+number of call-next transitions from --processes worker processes with
+--threads threads each, all against that department at once. It exits 1 if
+any token was returned by more than one call, if any seeded token was never
+called, or if more than one token is left in 'consulting'. The scratch
+rows are deleted afterwards.
+
+    python scripts/call_next_concurrency_check.py --processes 6 --threads 5 --tokens 180
+
+Database settings come from DB_* / .env as for the app; migrations must be
+applied and the patients table must hold at least one patient. The workers
+serve the display role only, so every process selects through SQL as separate
+workers do; pass --engine memory to exercise the queue engine's proposals too.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+
+def seed(department_id, count):
+    from app.db import get_db_connection
+
+    now = datetime.now()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT patient_id FROM patients LIMIT 1")
+            row = cur.fetchone()
+            if row is None:
+                raise SystemExit("the patients table is empty; add a patient first")
+            tokens = [str(uuid.uuid4()) for _ in range(count)]
+            for i, token in enumerate(tokens):
+                cur.execute("""
+                    INSERT INTO patient_tokens
+                    (token, id, patient_id, department_id, datetime, expires_at, status, status_updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, 'waiting', %s)
+                """, (token, i + 1, row[0], department_id, now, now + timedelta(days=1),
+                      now + timedelta(microseconds=i)))
+    return tokens
+
+
+def cleanup(department_id):
+    from app.db import get_db_connection
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM current_token WHERE department_id = %s", (department_id,))
+            cur.execute("DELETE FROM patient_tokens WHERE department_id = %s", (department_id,))
+            cur.execute("DELETE FROM queue_stats WHERE department_id = %s", (department_id,))
+
+
+def worker(department_id, threads, calls, start, results):
+    from app import create_app
+    from app.announcement_api import run_queue_transition
+
+    create_app()
+
+    called = []
+    errors = []
+
+    def run(n):
+        start.wait()
+        for _ in range(n):
+            try:
+                _, next_token = run_queue_transition("call_next", department_id)
+                if next_token:
+                    called.append(str(next_token["uuid"]))
+            except Exception as e:
+                errors.append(repr(e))
+
+    per_thread = [calls // threads + (1 if i < calls % threads else 0) for i in range(threads)]
+    pool = [threading.Thread(target=run, args=(n,)) for n in per_thread]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put({"called": called, "errors": errors})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=120)
+    parser.add_argument("--engine", default="off", choices=["off", "memory"])
+    args = parser.parse_args()
+
+    # Workers build the app like run.py does; the engine needs both roles
+    os.environ.update(QUEUE_ENGINE=args.engine,
+                      APP_ROLES="display,registration" if args.engine == "memory" else "display",
+                      NO_SHOW_SWEEP_INTERVAL="0", LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"))
+    department_id = f"CHK-{uuid.uuid4().hex[:8]}"
+    seeded = set(seed(department_id, args.tokens))
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        start = ctx.Event()
+        results = ctx.Queue()
+        per_process = [args.tokens // args.processes + (1 if i < args.tokens % args.processes else 0)
+                       for i in range(args.processes)]
+        procs = [ctx.Process(target=worker, args=(department_id, args.threads, n, start, results))
+                 for n in per_process]
+        for p in procs:
+            p.start()
+        start.set()
+        outcomes = [results.get(timeout=300) for _ in procs]
+        for p in procs:
+            p.join()
+
+        called = [token for outcome in outcomes for token in outcome["called"]]
+        errors = [error for outcome in outcomes for error in outcome["errors"]]
+        counts = Counter(called)
+
+        from app.db import get_db_connection
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT status, count(*) FROM patient_tokens WHERE department_id = %s GROUP BY status",
+                            (department_id,))
+                statuses = dict(cur.fetchall())
+
+        report = {
+            "department_id": department_id,
+            "calls": args.tokens,
+            "processes": args.processes,
+            "threads_per_process": args.threads,
+            "tokens_called": len(called),
+            "assigned_twice": sorted(t for t, n in counts.items() if n > 1),
+            "never_called": len(seeded - set(counts)),
+            "statuses": statuses,
+            "errors": errors[:10],
+        }
+        print(json.dumps(report, indent=2))
+        ok = (not report["assigned_twice"] and not report["never_called"] and not errors
+              and statuses.get("consulting", 0) <= 1)
+        sys.exit(0 if ok else 1)
+    finally:
+        cleanup(department_id)
+
+
+if __name__ == "__main__":
+    main()
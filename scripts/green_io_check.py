@@ -0,0 +1,69 @@
+"""Check that a slow query does not stall other requests under eventlet.
+
+Builds the app as run.py does (eventlet monkey-patched first), starts
+``SELECT pg_sleep(--sleep)`` on one pooled connection and, while it runs,
+sends --requests concurrent GET /api/current-tokens requests, which query
+the database too. With psycopg2's waits going through the eventlet hub
+(db.enable_green_io) every request finishes while the sleep is still in
+flight; the script exits 1 if any of them waited for it instead.
+
+    python scripts/green_io_check.py --sleep 1 --requests 5
+
+Database settings come from DB_* / .env as for the app.
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sleep", type=float, default=1.0, help="seconds the slow query runs")
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.update(APP_ROLES="display", NO_SHOW_SWEEP_INTERVAL="0", LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"))
+    from app import create_app
+    from app.db import get_db_connection, green_io_enabled
+
+    app = create_app()
+    client = app.test_client()
+    started = time.perf_counter()
+
+    def slow_query():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_sleep(%s)", (args.sleep,))
+        return time.perf_counter() - started
+
+    def request(_):
+        response = client.get("/api/current-tokens")
+        return response.status_code, time.perf_counter() - started
+
+    sleeper = eventlet.spawn(slow_query)
+    eventlet.sleep(0.05)   # let the sleep reach the server first
+    pool = eventlet.GreenPool(args.requests)
+    results = list(pool.imap(request, range(args.requests)))
+    sleep_done = sleeper.wait()
+
+    report = {
+        "green_io": green_io_enabled(),
+        "sleep_finished_s": round(sleep_done, 3),
+        "requests": [{"status": status, "finished_s": round(at, 3)} for status, at in results],
+    }
+    ok = report["green_io"] and all(status == 200 and at < sleep_done for status, at in results)
+    report["overlapped"] = ok
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
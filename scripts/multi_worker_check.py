@@ -0,0 +1,108 @@
+"""Start several workers on the Postgres event bus and check cross-worker delivery.
+
+Each worker is ``run.py`` on its own port with EVENT_BUS=postgres. A display
+client connects to the last worker and joins a department's room, then
+``/api/call-next`` is sent to the first worker; the script reports whether
+(and how quickly) the display received the resulting 'update-token'.
+
+    pip install "python-socketio[client]"
+    python scripts/multi_worker_check.py --workers 3 --department-id OPD
+
+The database in .env / DB_* must already hold at least one waiting token for
+the department, otherwise the update is the "No more tokens" message.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import socketio
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def start_workers(count, base_port):
+    workers = []
+    for i in range(count):
+        env = dict(os.environ, EVENT_BUS="postgres", PORT=str(base_port + i))
+        workers.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "run.py")], cwd=ROOT, env=env))
+    return workers
+
+
+def wait_until_up(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"worker on port {port} did not start")
+
+
+def post_json(url, payload):
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=5101)
+    parser.add_argument("--department-id", required=True)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error("need at least two workers")
+
+    workers = start_workers(args.workers, args.base_port)
+    try:
+        ports = [args.base_port + i for i in range(args.workers)]
+        for port in ports:
+            wait_until_up(port)
+
+        received = threading.Event()
+        result = {}
+        display = socketio.Client()
+
+        @display.on("update-token")
+        def on_update(data):
+            if str(data.get("department_id")) == str(args.department_id):
+                result["data"] = data
+                result["at"] = time.monotonic()
+                received.set()
+
+        display.connect(f"http://127.0.0.1:{ports[-1]}?department_id={args.department_id}",
+                        transports=["websocket"])
+        time.sleep(0.5)  # let the LISTEN connections settle
+
+        sent_at = time.monotonic()
+        response = post_json(f"http://127.0.0.1:{ports[0]}/api/call-next", {"department_id": args.department_id})
+        ok = received.wait(args.timeout)
+        display.disconnect()
+
+        report = {
+            "workers": args.workers,
+            "call_next_worker": ports[0],
+            "display_worker": ports[-1],
+            "call_next_response": response,
+            "delivered": ok,
+            "latency_ms": round((result["at"] - sent_at) * 1000, 1) if ok else None,
+            "event": result.get("data"),
+        }
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if ok else 1)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
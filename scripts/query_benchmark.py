@@ -0,0 +1,149 @@
+"""Compare the hot queries sent as plain SQL with their prepared catalog versions.
+
+For each statement in app/queries.py this runs --iterations calls both ways
+on one connection and reports:
+
+    inline     cur.execute(<sql>, params) with RealDictCursor rows (the old path)
+    prepared   queries.execute(...) -> EXECUTE <name>(...) with tuple rows
+
+with calls per second, mean latency, and the server's planning time from
+EXPLAIN ANALYZE (a prepared statement past its first executions reuses a
+cached plan, so its planning time drops to ~0). Transitions and inserts run
+inside a transaction that is rolled back, so the data is left unchanged.
+
+    python scripts/query_benchmark.py --department 1 --iterations 500 --output queries.json
+
+Database settings come from DB_* / .env as for the app.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from psycopg2.extras import RealDictCursor  # noqa: E402
+
+from app import queries  # noqa: E402
+from app.db import get_db_connection  # noqa: E402
+
+def sample_params(cur, department_id):
+    day_start = datetime.combine(date.today(), datetime.min.time())
+    cur.execute("""
+        SELECT token, patient_id FROM patient_tokens
+        WHERE department_id = %s AND datetime >= %s AND datetime < %s
+        ORDER BY id LIMIT 1
+    """, (department_id, day_start, day_start + timedelta(days=1)))
+    row = cur.fetchone()
+    token, patient_id = (str(row[0]), row[1]) if row else (str(uuid.uuid4()), "P1")
+
+    queue = {"department_id": department_id, "day_start": day_start, "day_end": day_start + timedelta(days=1)}
+    transition = {"department_id": department_id, "candidate": None, "candidate_status": None}
+    counter = {"count": 1, "department_id": department_id, "day": date.today()}
+    return {
+        "call_next": transition,
+        "move_next": transition,
+        "current_tokens": {},
+        "current_tokens_for": {"department_ids": [department_id]},
+        "announce_current": {"department_id": department_id},
+        "bump_token_counter": counter,
+        "seed_token_counter": dict(counter, day_start=queue["day_start"], day_end=queue["day_end"]),
+        "insert_token": {"token": str(uuid.uuid4()), "id": 999999, "patient_id": patient_id,
+                         "department_id": department_id, "datetime": datetime.now(),
+                         "expires_at": datetime.now() + timedelta(days=1), "now": datetime.now()},
+        "card_details": {"token": token},
+        "queue_signature": queue,
+        "queue_rows": queue,
+        "queue_changes": dict(queue, since_at=datetime.min, since_token=str(uuid.UUID(int=0)), limit=501),
+    }
+
+
+def _run_inline(conn, name, params):
+    stmt = queries.CATALOG[name]
+    prefix = queries.QUEUE_LOCK_SQL if name in ("call_next", "move_next") else ""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(prefix + stmt.sql, params)
+        if cur.description:
+            cur.fetchall()
+
+
+def _run_prepared(conn, name, params):
+    prefix = queries.QUEUE_LOCK_SQL if name in ("call_next", "move_next") else ""
+    with conn.cursor() as cur:
+        queries.execute(cur, name, params, prefix=prefix)
+        if cur.description:
+            cur.fetchall()
+
+
+def throughput(conn, run, name, params, iterations):
+    # Warm up (for prepared: PREPARE plus the custom-plan executions before
+    # the server switches to the cached generic plan)
+    for _ in range(6):
+        run(conn, name, params)
+        conn.rollback()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        run(conn, name, params)
+        conn.rollback()
+    elapsed = time.perf_counter() - started
+    return {"calls_per_s": round(iterations / elapsed, 1), "mean_ms": round(elapsed / iterations * 1000, 3)}
+
+
+def planning_ms(conn, name, params, prepared):
+    stmt = queries.CATALOG[name]
+    sql = stmt.execute_sql if prepared else stmt.sql
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + sql, params)
+        plan = cur.fetchone()[0][0]
+    conn.rollback()
+    return plan.get("Planning Time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--department", default="1", help="department whose queue the statements read")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--statements", default=",".join(queries.CATALOG))
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.statements.split(",") if n.strip()]
+    unknown = set(names) - set(queries.CATALOG)
+    if unknown:
+        parser.error(f"unknown statements: {', '.join(sorted(unknown))}")
+
+    # Measure the prepared path even if PREPARED_STATEMENTS=0 is configured
+    queries.PREPARED_STATEMENTS = True
+
+    report = {"department": args.department, "iterations": args.iterations, "statements": {}}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            params = sample_params(cur, args.department)
+        conn.rollback()
+        for name in names:
+            inline = throughput(conn, _run_inline, name, params[name], args.iterations)
+            inline["planning_ms"] = planning_ms(conn, name, params[name], prepared=False)
+            prepared = throughput(conn, _run_prepared, name, params[name], args.iterations)
+            prepared["planning_ms"] = planning_ms(conn, name, params[name], prepared=True)
+            report["statements"][name] = {
+                "inline": inline,
+                "prepared": prepared,
+                "speedup": round(prepared["calls_per_s"] / inline["calls_per_s"], 2),
+            }
+            print(f"{name:<20} inline {inline['calls_per_s']:>9.1f}/s plan {inline['planning_ms']:>7.3f} ms   "
+                  f"prepared {prepared['calls_per_s']:>9.1f}/s plan {prepared['planning_ms']:>7.3f} ms   "
+                  f"x{report['statements'][name]['speedup']}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()